@@ -4,25 +4,48 @@
 # TREASURE PROJECT 2021
 
 import gc
+from contextlib import contextmanager
 import time
-import os
-import sys
-import socket,fcntl,struct
+import struct
 import numpy as np
-from videocore.v3d import *
-from videocore.driver import Driver
 import random
-from random import shuffle
-import tracemalloc
-import pandas as pd
 import hashlib
-import psutil
-import rpi_vcsm
-from cgroups import Cgroup
-from videocore.assembler import qpu, assemble, print_qbin
 from random import getrandbits
-
-dri=Driver()
+import collector
+import hal
+import lazy_imports
+from gpu_session import GPUSession
+from scheduler import Scheduler, Task, WAIT, SHARED
+from feature_registry import Registry, PRESETS
+import storage_bench
+import memory_bench
+import memory_pressure
+import counters
+import entropy
+import bench_stats
+import calibration
+import thermal
+import telemetry
+import fixtures
+from bench_helper import BenchHelper
+
+# py-videocore on a Pi Zero/1/2/3, or the NumPy simulator with TREASURE_BACKEND=sim;
+# nothing is imported until the first feature that needs the GPU runs.
+hw = hal.lazy('vc4')
+qpu = hw.kernel
+gpu_imports = hal.modules('vc4')
+
+session = GPUSession(hw)
+scheduler = Scheduler()
+monitor = thermal.Thermal()
+storage_backend = 'syscall'
+storage_cache = 'cached'
+# MB, cgroup limit of the memory_pressure test
+memory_limit = 64
+mmap_advice = None
+qpu_curve = False
+true_random_chunks = False
+cpu_reps = 0
 
 MEGABYTE = 1024 * 1024
 
@@ -39,10 +62,8 @@ def bytes2human(n, format="%(value).1f%(symbol)s"):
 
 def memory_reserve(mbytes):
     # http://man7.org/linux/man-pages/man7/cgroups.7.html
-    # system memory to be reserved to the script
-    cg = Cgroup('mem-fingerprint',"memory")
-    cg.set_memory_limit(mbytes)
-    cg.add(os.getpid())
+    # fill twice mbytes of anonymous memory in a child limited to mbytes
+    return memory_pressure.pressure_test(mbytes)
 
 def memory_fill(mbytes):
     # consume: MB of reserved memory
@@ -52,6 +73,7 @@ def memory_fill(mbytes):
 
 def memory_info():
     # Pretty print the tuple returned in psutil.virtual_memory()
+    import psutil
     nt = psutil.virtual_memory()
     for name in nt._fields:
         value = getattr(nt, name)
@@ -60,11 +82,13 @@ def memory_info():
         print('%-10s : %7s' % (name.capitalize(), value))
 
 def tracing_start():
+    import tracemalloc
     tracemalloc.stop()
     tracemalloc.start()
 
 
 def tracing_mem():
+    import tracemalloc
     first_size, first_peak = tracemalloc.get_traced_memory()
     peak = first_peak / (1024 * 1024)
     return peak
@@ -75,42 +99,8 @@ def fib(n):
     return fib(n - 1) + fib(n - 2)
 
 
-def write_test(file, block_size, blocks_count, show_progress=False):
-    f = os.open(file, os.O_CREAT | os.O_WRONLY, 0o777)  # low-level I/O
-
-    took = []
-    for i in range(blocks_count):
-        buff = os.urandom(block_size)
-        start = time.perf_counter_ns()
-        os.write(f, buff)
-        os.fsync(f)  # force write to disk
-        t = time.perf_counter_ns() - start
-        took.append(t)
-
-    os.close(f)
-    return took
-
-
-def read_test(file, block_size, blocks_count, show_progress=False):
-    f = os.open(file, os.O_RDONLY, 0o777)  # low-level I/O
-    # generate random read positions
-    offsets = list(range(0, blocks_count * block_size, block_size))
-    shuffle(offsets)
-
-    took = []
-    for i, offset in enumerate(offsets, 1):
-        start = time.perf_counter_ns()
-        os.lseek(f, offset, os.SEEK_SET)  # set position
-        buff = os.read(f, block_size)  # read from position
-        t = time.perf_counter_ns() - start
-        if not buff: break  # if EOF reached
-        took.append(t)
-
-    os.close(f)
-    return took
-
-
 def csv_read():
+    import pandas as pd
     start = time.perf_counter_ns()
     df = pd.read_csv("test_dataset.csv")
     end = time.perf_counter_ns()
@@ -125,8 +115,7 @@ def array_append():
     end = time.perf_counter_ns()
     return end-start
     
-def memory_reserve():
-    #memory_reserve(100)
+def memory_fill_test():
     start = time.perf_counter_ns()
     memory_fill(100)
     end = time.perf_counter_ns()
@@ -605,8 +594,8 @@ def sgemm_gpu_code(asm):
     exit(interrupt=False)
     
 def sgemm():
-    cache_mode=rpi_vcsm.CACHE_NONE
-    with dri as drv:
+    cache_mode=hw.rpi_vcsm.CACHE_NONE
+    with session.pool() as drv:
         p = 96
         q = 363
         r = 3072
@@ -625,17 +614,11 @@ def sgemm():
         B = drv.alloc((q, r), 'float32')
 
         # Initialize matrices.
-        np.random.seed(0)
         alpha = 1.0
         beta = 1.0
-        A[:] = np.random.randn(p, q)
-        B[:] = np.random.randn(q, r)
-        C[:] = np.random.randn(p, r)
-
-        # Reference
-        start = time.perf_counter_ns()
-        R = alpha*A.dot(B) + beta*C
-        elapsed_ref = time.perf_counter_ns() - start
+        A[:] = fixtures.randn((p, q), seed=0)
+        B[:] = fixtures.randn((q, r), seed=1)
+        C[:] = fixtures.randn((p, r), seed=2)
 
         # Allocate uniforms.
         uniforms = drv.alloc((n_threads, 14), 'uint32')
@@ -662,11 +645,11 @@ def sgemm():
         uniforms[:, 13] = n_threads
 
         # Allocate GPU program.
-        code = drv.program(sgemm_gpu_code)
+        code = session.program(sgemm_gpu_code)
 
         # GPU
         start = time.perf_counter_ns()
-        if cache_mode in [rpi_vcsm.CACHE_HOST, rpi_vcsm.CACHE_BOTH]:
+        if cache_mode in [hw.rpi_vcsm.CACHE_HOST, hw.rpi_vcsm.CACHE_BOTH]:
             A.clean()
             B.clean()
             C.clean()
@@ -675,7 +658,7 @@ def sgemm():
                 program=code,
                 uniforms=uniforms
                 )
-        if cache_mode in [rpi_vcsm.CACHE_HOST, rpi_vcsm.CACHE_BOTH]:
+        if cache_mode in [hw.rpi_vcsm.CACHE_HOST, hw.rpi_vcsm.CACHE_BOTH]:
             C.invalidate()
         elapsed_gpu = time.perf_counter_ns() - start
 
@@ -700,15 +683,13 @@ def boilerplate(asm, f, nout):
     exit()
 
 def run_code(code, X, output_shape, output_type):
-    cache_mode = rpi_vcsm.CACHE_NONE
-    dri=Driver()
-    with dri as drv:
+    with session.pool() as drv:
         X = drv.copy(X)
         Y = drv.alloc(output_shape, dtype=output_type)
         start = time.perf_counter_ns()
         drv.execute(
                 n_threads=1,
-                program=drv.program(boilerplate, code, output_shape[0]),
+                program=session.program(boilerplate, code, output_shape[0]),
                 uniforms=[X.address, Y.address]
                 )
         elapsed_gpu = time.perf_counter_ns() - start
@@ -803,94 +784,263 @@ def sleep(duration):
         now = time.perf_counter_ns()
 
 def get_QPU_freq(s):
-    with RegisterMapping(dri) as regmap:
-        with PerformanceCounter(regmap, [13,14,15,16,17,18,19]) as pctr:
+    with hw.RegisterMapping(session.open()) as regmap:
+        with hw.PerformanceCounter(regmap, [13,14,15,16,17,18,19]) as pctr:
             time.sleep(s)
             result = pctr.result()
             return (sum(result) * 1e-6)
 
+def get_QPU_freq_series(durations, resolution=1.0, curve=False):
+    # One counter run instead of get_QPU_freq(d) for each d in durations:
+    # the counters are read at the cumulative checkpoints and every
+    # `resolution` seconds in between.
+    times = counters.schedule(durations, resolution)
+    with hw.RegisterMapping(session.open()) as regmap:
+        with hw.PerformanceCounter(regmap, [13,14,15,16,17,18,19]) as pctr:
+            counts = counters.series(pctr, times)
+    result = counters.checkpoint_values(times, counts, durations)
+    if curve:
+        result += counters.rate(times, counts)
+    return result
+
 def cpu_random():
-    with RegisterMapping(dri) as regmap:
-        with PerformanceCounter(regmap, [13,14,15,16,17,28,19]) as pctr:
+    with hw.RegisterMapping(session.open()) as regmap:
+        with hw.PerformanceCounter(regmap, [13,14,15,16,17,28,19]) as pctr:
             a=random.random()
             result = pctr.result()
             return (sum(result))
 
 def cpu_true_random(n):
-    with RegisterMapping(dri) as regmap:
-        with PerformanceCounter(regmap, [13,14,15,16,17,28,19]) as pctr:
-            a=os.urandom(n)
-            result = pctr.result()
-            return (sum(result))
+    # n bytes from /dev/urandom in entropy.CHUNK pieces into one reused
+    # buffer; the total is comparable to timing os.urandom(n) as a whole
+    with cycle_counter() as pctr:
+        took = entropy.read_chunks(pctr, n)
+    total = int(took.sum())
+    return np.concatenate(([total], took)) if true_random_chunks else total
 
 def cpu_hash():
-    with RegisterMapping(dri) as regmap:
-         with PerformanceCounter(regmap, [13,14,15,16,17,28,19]) as pctr:
+    with hw.RegisterMapping(session.open()) as regmap:
+         with hw.PerformanceCounter(regmap, [13,14,15,16,17,28,19]) as pctr:
              h=int(hashlib.sha256("test string".encode('utf-8')).hexdigest(), 16) % 10**8
              result = pctr.result()
              return (sum(result))
 
 def cpu_fib(n):
-    with RegisterMapping(dri) as regmap:
-         with PerformanceCounter(regmap, [13,14,15,16,17,28,19]) as pctr:
+    with hw.RegisterMapping(session.open()) as regmap:
+         with hw.PerformanceCounter(regmap, [13,14,15,16,17,28,19]) as pctr:
              h=fib(n)
              result = pctr.result()
              return (sum(result))
 
-def getHwAddr(ifname):
-    try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        info = fcntl.ioctl(s.fileno(), 0x8927,  struct.pack('256s', bytes(ifname, 'utf-8')[:15]))
-        return ':'.join('%02x' % b for b in info[18:24])
-    except:
-        return "00:00:00:00:00:00"
-    
+@contextmanager
+def cycle_counter():
+    # the counter setup of the cpu_* tests, for calibration
+    with hw.RegisterMapping(session.open()) as regmap:
+        with hw.PerformanceCounter(regmap, [13,14,15,16,17,28,19]) as pctr:
+            yield pctr
+
+def cpu_batch(op, n, *args):
+    # n repetitions of op(*args) under one counter setup; the counter setup
+    # costs more than a single hash or random.random() call.
+    took = np.zeros(n, dtype=np.int64)
+    with hw.RegisterMapping(session.open()) as regmap:
+        with hw.PerformanceCounter(regmap, [13,14,15,16,17,28,19]) as pctr:
+            for i in range(n):
+                start = np.array(pctr.result(), dtype=np.int64)
+                op(*args)
+                end = np.array(pctr.result(), dtype=np.int64)
+                took[i] = ((end - start) % counters.WRAP).sum()
+    return bench_stats.robust_stats(took)
+
+def hash_op():
+    return int(hashlib.sha256("test string".encode('utf-8')).hexdigest(), 16) % 10**8
+
+def mac_address():
+    # first interface but lo
+    return telemetry.mac_address()
+
+# The legacy cpu_sleep_* columns still need a 138 s counter run (their
+# cumulative sum), so the series only saves time per sample when other
+# tasks overlap this WAIT one, i.e. with --parallel.
+SLEEPS = [1, 2, 5, 10, 120]
+TRUE_RANDOM_BYTES = 100000000
+
+def qpu_freq_task():
+    curve_columns=[]
+    if qpu_curve:
+        curve_columns=[f'qpu_mhz_{t:g}s' for t in counters.schedule(SLEEPS)]
+    return Task(get_QPU_freq_series, SLEEPS, curve=qpu_curve, kind=WAIT,
+                resources=['pctr'], imports=gpu_imports,
+                columns=[f'cpu_sleep_{d}s' for d in SLEEPS] + curve_columns, dtype='float32')
+
+def cpu_task(name, fn, op, *args):
+    # one counter reading per test, or cpu_reps of them summarised
+    if cpu_reps > 0:
+        return Task(cpu_batch, op, cpu_reps, *args, resources=['pctr'], imports=gpu_imports,
+                    columns=bench_stats.stat_columns(name), dtype='float64', overhead='pctr_read')
+    return Task(fn, *args, resources=['pctr'], imports=gpu_imports, overhead='pctr_setup')
+
+def true_random_task():
+    task = cpu_task('cpu_true_random', cpu_true_random, entropy.read, TRUE_RANDOM_BYTES)
+    if cpu_reps <= 0:
+        # chunks are milliseconds long, the counter reads around them don't matter
+        task.overhead = None
+        if true_random_chunks:
+            task.columns = ['cpu_true_random'] + [
+                f'cpu_true_random_chunk_{i}'
+                for i in range(1, len(entropy.sizes(TRUE_RANDOM_BYTES)) + 1)]
+    return task
+
+def storage_columns(op):
+    # the page-cache mode is part of the column names; cached keeps the old ones
+    mode = '' if storage_cache == 'cached' else f'{storage_cache}_'
+    return [f'storage_{op}_{mode}{i}' for i in range(1, 101)]
+
+def mmap_task():
+    if mmap_advice is None:
+        return None
+    pages = 102400 * 100 // storage_bench.mmap.PAGESIZE
+    return Task(storage_bench.mmap_read_test, "test", 102400, 100, mmap_advice,
+                kind=SHARED, resources=['storage'], overhead='perf_counter',
+                columns=[f'storage_mmap_{i}' for i in range(1, pages + 1)])
+
+# Costs are rough Pi Zero/3 timings in seconds. The lite preset leaves out
+# cpu_true_random (100 MB from /dev/urandom) and csv_read (imports pandas).
+registry = Registry('vc4')
+selection = {}
+overhead = {}
+#### GPU-CPU data
+registry.register('cpu_sleep', qpu_freq_task, cost=138)
+registry.register('cpu_hash', lambda: cpu_task('cpu_hash', cpu_hash, hash_op),
+                  cost=0.05, presets=PRESETS)
+registry.register('cpu_random', lambda: cpu_task('cpu_random', cpu_random, random.random),
+                  cost=0.02, presets=PRESETS)
+registry.register('cpu_true_random', true_random_task, cost=8.0)
+registry.register('cpu_fib', lambda: cpu_task('cpu_fib', cpu_fib, fib, 20),
+                  cost=0.5, presets=PRESETS)
+registry.register('sgemm',
+                  lambda: Task(sgemm, resources=['gpu'], imports=gpu_imports,
+                               columns=['gpu_matrixmul'], overhead='perf_counter'),
+                  boards=['vc4'], cost=2.0, presets=PRESETS)
+registry.register('cond_add',
+                  lambda: Task(test_cond_add, resources=['gpu'], imports=gpu_imports,
+                               columns=['gpu_cond_add'], overhead='perf_counter'),
+                  boards=['vc4'], cost=0.05, presets=PRESETS)
+registry.register('cond_mul',
+                  lambda: Task(test_cond_mul, resources=['gpu'], imports=gpu_imports,
+                               columns=['gpu_cond_mul'], overhead='perf_counter'),
+                  boards=['vc4'], cost=0.05, presets=PRESETS)
+#### Memory test
+registry.register('array_append',
+                  lambda: Task(array_append, kind=SHARED, resources=['memory'],
+                               columns=['memory_array_append'], overhead='perf_counter'),
+                  cost=0.05, presets=PRESETS)
+registry.register('memory_fill',
+                  lambda: Task(memory_fill_test, kind=SHARED, resources=['memory'],
+                               columns=['memory_fill'], overhead='perf_counter'),
+                  cost=0.5, presets=PRESETS)
+# Not part of any preset, --include them by name.
+registry.register('memory_latency',
+                  lambda: Task(memory_bench.latency_sweep, resources=['memory'], dtype='float64',
+                               columns=memory_bench.latency_columns()),
+                  cost=10.0, presets=())
+registry.register('memory_bandwidth',
+                  lambda: Task(memory_bench.bandwidth_sweep, resources=['memory'], dtype='float64',
+                               columns=memory_bench.bandwidth_columns()),
+                  cost=1.5, presets=())
+registry.register('memory_pressure',
+                  lambda: Task(memory_reserve, memory_limit, resources=['memory'], dtype='float64',
+                               columns=memory_pressure.pressure_columns()),
+                  cost=3.0, presets=())
+#### Storage test
+registry.register('csv_read',
+                  lambda: Task(csv_read, kind=SHARED, resources=['storage'], imports=['pandas'],
+                               columns=['storage_csv_read'], overhead='perf_counter'),
+                  cost=0.5)
+registry.register('write_test',
+                  lambda: Task(storage_bench.write_test, "test", 102400, 100, storage_backend,
+                               storage_cache,
+                               kind=SHARED, resources=['storage'], overhead='perf_counter',
+                               columns=storage_columns('write')),
+                  cost=2.0, presets=PRESETS)
+registry.register('read_test',
+                  lambda: Task(storage_bench.read_test, "test", 102400, 100, storage_backend,
+                               storage_cache,
+                               kind=SHARED, resources=['storage'], overhead='perf_counter',
+                               columns=storage_columns('read')),
+                  cost=0.2, presets=PRESETS)
+registry.register('mmap_read_test', mmap_task, cost=0.5)
+registry.register('queue_depth_sweep',
+                  lambda: Task(storage_bench.queue_depth_features, "test_qd", cache=storage_cache,
+                               kind=SHARED, resources=['storage'], dtype='float64',
+                               columns=storage_bench.queue_depth_columns(cache=storage_cache)),
+                  cost=30.0, presets=())
+
+def features():
+    return registry.tasks(**selection)
+
+def schema():
+    columns = [('temperature', 'float32')]
+    for task in features():
+        columns += [(c, task.dtype) for c in task.columns]
+    if monitor.trace:
+        columns += [(c, 'float32') for c in thermal.COLUMNS]
+    return columns
+
+def sample():
+    mac=mac_address()
+    record={}
+
+    record['timestamp']=time.time()
+
+    record['temperature']=telemetry.temperature()
+
+    tasks=features()
+    monitor.reset()
+    for task, value in zip(tasks, scheduler.run(tasks)):
+        record.update(zip(task.columns, value if isinstance(value, (list, np.ndarray)) else [value]))
+    if overhead:
+        calibration.subtract(record, tasks, overhead)
+    if monitor.trace:
+        record.update(monitor.features())
+
+    record['label']=mac
+    return record
+
 def main():
+    args = collector.parse_args(features=registry.names())
+    global storage_backend, storage_cache, memory_limit, mmap_advice, qpu_curve, cpu_reps
+    global true_random_chunks, selection, overhead, monitor
+    scheduler.cores = args.parallel
+    monitor = thermal.Thermal(args.thermal_band, args.thermal_timeout, trace=args.thermal_trace)
+    if monitor.active:
+        scheduler.gate = monitor.gate
+    storage_backend = args.storage_backend
+    storage_cache = args.storage_cache
+    memory_limit = args.memory_limit
+    mmap_advice = args.mmap_read
+    qpu_curve = args.qpu_curve
+    true_random_chunks = args.true_random_chunks
+    cpu_reps = args.cpu_reps
+    selection = dict(include=args.include, exclude=args.exclude, preset=args.preset)
+    if args.list_features:
+        registry.describe()
+        return
+    if args.profile_imports:
+        lazy_imports.report(features())
     gc.disable()
-
-    s=120
-    r=100000000
-
-    inter=list(psutil.net_if_addrs().keys())
-    inter.remove('lo')
-    inter=inter[0]
-    mac=getHwAddr(inter)
-
-    results=[]
-
-    results.append(time.time())
-
-    results.append(os.popen("vcgencmd measure_temp | cut -d = -f 2 | cut -d \"'\" -f 1").read()[:-1])
-
-    #### GPU-CPU data
-    results.append(get_QPU_freq(1))
-    results.append(get_QPU_freq(2))
-    results.append(get_QPU_freq(5))
-    results.append(get_QPU_freq(10))
-    results.append(get_QPU_freq(s))
-
-    results.append(cpu_hash())
-    results.append(cpu_random())
-    results.append(cpu_true_random(r))
-    results.append(cpu_fib(20))
-
-    results.append(sgemm())
-    results.append(test_cond_add())
-    results.append(test_cond_mul())
-
-    #### Memory test
-    results.append(array_append())
-    results.append(memory_reserve())
-
-    #### Storage test
-    results.append(csv_read())
-    for i in write_test("test",102400,100):
-        results.append(i)
-    for i in read_test("test",102400,100):
-        results.append(i)
-
-    results.append(mac)
-    print(*results, sep=',')
+    store = collector.open_store(args, schema(), mac_address())
+    with session:
+        if args.calibrate or args.subtract_overhead:
+            medians = calibration.load_or_run(
+                args.output or '.', mac_address(),
+                lambda: calibration.calibrate(BenchHelper('./libbench_helper.so'), cycle_counter),
+                force=args.calibrate)
+            if args.subtract_overhead:
+                overhead = medians
+        collector.run(sample, samples=args.samples, burst=args.burst,
+                      cooldown=args.cooldown, gap=args.gap, store=store,
+                      max_failures=args.max_failures)
 
 if __name__ == "__main__":
     main()
@@ -3,30 +3,60 @@
 # Testing for Raspberry Pi 4 Benchmarking and device identification.
 # TREASURE PROJECT 2021
 import gc
+from contextlib import contextmanager
 import time
 from time import clock_gettime,CLOCK_MONOTONIC
 from time import monotonic
-import fcntl
-import socket
-import struct
 import numpy as np
-from videocore6.v3d import *
-from videocore6 import pack_unpack
-from videocore6.driver import Driver
-from videocore6.assembler import qpu
+import hal
+import lazy_imports
 from bench_helper import BenchHelper
-import sys
-import os
+import collector
+from gpu_session import GPUSession
+from scheduler import Scheduler, Task, WAIT, SHARED
+from feature_registry import Registry, PRESETS
+import storage_bench
+import memory_bench
+import memory_pressure
+import counters
+import entropy
+import bench_stats
+import calibration
+import thermal
+import telemetry
+import fixtures
 import random
 import hashlib
-from random import shuffle
-import tracemalloc
-import pandas as pd
-from cgroups import Cgroup
-import psutil
 
 MEGABYTE = 1024 * 1024
 
+# py-videocore6 on a Pi 4, or the NumPy simulator with TREASURE_BACKEND=sim;
+# nothing is imported until the first feature that needs the GPU runs.
+hw = hal.lazy('vc6')
+qpu = hw.kernel
+gpu_imports = hal.modules('vc6')
+
+# Sized for the biggest test: summation over 32M words (scopy needs the same).
+session = GPUSession(hw, data_area_size=(32 * MEGABYTE + 1024) * 4)
+scheduler = Scheduler()
+monitor = thermal.Thermal()
+storage_backend = 'syscall'
+storage_cache = 'cached'
+# MB, cgroup limit of the memory_pressure test
+memory_limit = 64
+mmap_advice = None
+qpu_curve = False
+true_random_chunks = False
+cpu_reps = 0
+wait_strategy = 'spin'
+# sgemm_rnn_naive configuration (--sgemm) and reference check (--sgemm-check)
+sgemm_config = dict(P=1024, Q=1024, R=1024, thread=8, tiling=(2, 4))
+sgemm_check = False
+# (P, Q, R, thread, tiling) run by the sgemm_sweep feature
+SGEMM_SWEEP = [(n, n, n, thread, tiling) for n in (256, 512, 1024)
+               for thread, tiling in ((1, (1, 1)), (8, (2, 4)), (8, (4, 2)),
+                                      (16, (4, 4)), (16, (2, 8)))]
+
 def bytes2human(n, format="%(value).1f%(symbol)s"):
     symbols = ('B', 'K', 'M', 'G', 'T', 'P', 'E', 'Z', 'Y')
     prefix = {}
@@ -40,10 +70,8 @@ def bytes2human(n, format="%(value).1f%(symbol)s"):
 
 def memory_reserve(mbytes):
     # http://man7.org/linux/man-pages/man7/cgroups.7.html
-    # system memory to be reserved to the script
-    cg = Cgroup('mem-fingerprint',"memory")
-    cg.set_memory_limit(mbytes)
-    cg.add(os.getpid())
+    # fill twice mbytes of anonymous memory in a child limited to mbytes
+    return memory_pressure.pressure_test(mbytes)
 
 def memory_fill(mbytes):
     # consume: MB of reserved memory
@@ -53,6 +81,7 @@ def memory_fill(mbytes):
 
 def memory_info():
     # Pretty print the tuple returned in psutil.virtual_memory()
+    import psutil
     nt = psutil.virtual_memory()
     for name in nt._fields:
         value = getattr(nt, name)
@@ -61,11 +90,13 @@ def memory_info():
         print('%-10s : %7s' % (name.capitalize(), value))
 
 def tracing_start():
+    import tracemalloc
     tracemalloc.stop()
     tracemalloc.start()
 
 
 def tracing_mem():
+    import tracemalloc
     first_size, first_peak = tracemalloc.get_traced_memory()
     peak = first_peak / (1024 * 1024)
     return peak
@@ -76,41 +107,8 @@ def fib(n):
     return fib(n - 1) + fib(n - 2)
 
 
-def write_test(file, block_size, blocks_count, show_progress=False):
-    f = os.open(file, os.O_CREAT | os.O_WRONLY, 0o777)  # low-level I/O
-
-    took = []
-    for i in range(blocks_count):
-        buff = os.urandom(block_size)
-        start = time.perf_counter_ns()
-        os.write(f, buff)
-        os.fsync(f)  # force write to disk
-        t = time.perf_counter_ns() - start
-        took.append(t)
-
-    os.close(f)
-    return took
-
-
-def read_test(file, block_size, blocks_count, show_progress=False):
-    f = os.open(file, os.O_RDONLY, 0o777)  # low-level I/O
-    # generate random read positions
-    offsets = list(range(0, blocks_count * block_size, block_size))
-    shuffle(offsets)
-
-    took = []
-    for i, offset in enumerate(offsets, 1):
-        start = time.perf_counter_ns()
-        os.lseek(f, offset, os.SEEK_SET)  # set position
-        buff = os.read(f, block_size)  # read from position
-        t = time.perf_counter_ns() - start
-        if not buff: break  # if EOF reached
-        took.append(t)
-
-    os.close(f)
-    return took
-
 def csv_read():
+    import pandas as pd
     start = time.perf_counter_ns()
     df = pd.read_csv("test_dataset.csv")
     end = time.perf_counter_ns()
@@ -125,8 +123,7 @@ def array_append():
     end = time.perf_counter_ns()
     return end-start
  
-def memory_reserve():
-    #memory_reserve(100)
+def memory_fill_test():
     start = time.perf_counter_ns()
     memory_fill(100)
     end = time.perf_counter_ns()
@@ -316,43 +313,46 @@ def qpu_sgemm_rnn_naive(asm, thread):
     nop()
     nop()
 
-def sgemm_rnn_naive():
+def sgemm_gflops(P, Q, R, ns):
+    return (2 * P * Q * R + 3 * P * R) / ns
 
-    thread = 8
+def sgemm_inputs(P, Q, R, seed):
+    # alpha, beta, A, B, C; the matrices come from the fixture store
+    alpha, beta = np.random.RandomState(seed).randn(2)
+    return (alpha, beta, fixtures.randn((P, Q), seed=seed),
+            fixtures.randn((Q, R), seed=seed + 1), fixtures.randn((P, R), seed=seed + 2))
 
-    P = 1024
-    Q = 1024
-    R = 1024
+def sgemm_reference(P, Q, R, seed):
+    # alpha * A.dot(B) + beta * C, computed once per seed and size
+    def compute():
+        alpha, beta, A, B, C = sgemm_inputs(P, Q, R, seed)
+        return alpha * A.dot(B) + beta * C
+    return fixtures.get(f'sgemm_ref_q{Q}', (P, R), 'float32', seed, compute)
 
-    assert P % (16 * 2) == 0
-    assert R % (16 * 4) == 0
+def sgemm_rnn_naive(P=1024, Q=1024, R=1024, thread=8, tiling=(2, 4), check=False, seed=0):
+    # tiling: C is split in rows x cols blocks, one per thread
+    rows, cols = tiling
+    assert rows * cols == thread
+    assert P % (16 * rows) == 0
+    assert R % (16 * cols) == 0
 
-    with Driver() as drv:
+    with session.pool() as drv:
 
-        code = drv.program(lambda asm: qpu_sgemm_rnn_naive(asm, thread))
+        code = session.program(qpu_sgemm_rnn_naive, thread)
 
         A = drv.alloc((P, Q), dtype = 'float32')
         B = drv.alloc((Q, R), dtype = 'float32')
         C = drv.alloc((P, R), dtype = 'float32')
 
-        np.random.seed(0)
-        alpha = np.random.randn()
-        beta = np.random.randn()
-        A_ref = np.random.randn(*A.shape).astype(A.dtype)
-        B_ref = np.random.randn(*B.shape).astype(B.dtype)
-        C_ref = np.random.randn(*C.shape).astype(C.dtype)
+        alpha, beta, A_ref, B_ref, C_ref = sgemm_inputs(P, Q, R, seed)
 
         A[:] = A_ref
         B[:] = B_ref
         C[:] = C_ref
 
-        start = time.perf_counter_ns()
-        C_ref[:] = alpha * A_ref.dot(B_ref) + beta * C_ref
-        time_ref = time.perf_counter_ns() - start
-
-        def block_2x4_params(i, j):
-            tile_P = P // 2
-            tile_R = R // 4
+        def block_params(i, j):
+            tile_P = P // rows
+            tile_R = R // cols
             return [
                 tile_P, Q, tile_R,
                 A.addresses()[tile_P*i, 0       ],
@@ -361,12 +361,12 @@ def sgemm_rnn_naive():
                 B.strides[0],
                 C.addresses()[tile_P*i, tile_R*j],
                 C.strides[0],
-                *pack_unpack('f', 'I', [alpha, beta]),
+                *hw.pack_unpack('f', 'I', [alpha, beta]),
             ]
 
-        unif_params = drv.alloc((thread, len(block_2x4_params(0,0))), dtype = 'uint32')
+        unif_params = drv.alloc((thread, len(block_params(0,0))), dtype = 'uint32')
         for th in range(thread):
-            unif_params[th] = block_2x4_params(th // 4, th % 4)
+            unif_params[th] = block_params(th // cols, th % cols)
 
         unif = drv.alloc(2, dtype = 'uint32')
         unif[0] = unif_params.addresses()[0,0]
@@ -376,12 +376,18 @@ def sgemm_rnn_naive():
         drv.execute(code, unif.addresses()[0], thread = thread)
         time_gpu = time.perf_counter_ns() - start
 
-        np.set_printoptions(threshold=np.inf)
+        if check:
+            assert np.allclose(C, sgemm_reference(P, Q, R, seed), rtol = 1e-3, atol = 1e-3)
 
-        def Gflops(sec):
-            return (2 * P * Q * R + 3 * P * R) / sec * 1e-9
+        return time_gpu
 
-        return time_gpu #Gflops(time_ref),time_gpu,Gflops(time_gpu)]
+def sgemm_sweep(configs, check=False):
+    # [time_gpu, gflops] of each (P, Q, R, thread, tiling) configuration
+    result = []
+    for P, Q, R, thread, tiling in configs:
+        time_gpu = sgemm_rnn_naive(P, Q, R, thread, tiling, check)
+        result += [time_gpu, sgemm_gflops(P, Q, R, time_gpu)]
+    return result
 
 def sleep(duration):
     duration=duration*1000000000
@@ -391,40 +397,77 @@ def sleep(duration):
         now = time.perf_counter_ns()
 
 def get_QPU_freq(seg):
-    with RegisterMapping() as regmap:
-        with PerformanceCounter(regmap, [CORE_PCTR_CYCLE_COUNT]) as pctr:
+    with hw.RegisterMapping() as regmap:
+        with hw.PerformanceCounter(regmap, [hw.CORE_PCTR_CYCLE_COUNT]) as pctr:
             time.sleep(seg)
             result = pctr.result()
             return (result[0] * 1e-6)
 
+def get_QPU_freq_series(durations, resolution=1.0, curve=False):
+    # One counter run instead of get_QPU_freq(d) for each d in durations:
+    # the counter is read at the cumulative checkpoints and every
+    # `resolution` seconds in between.
+    times = counters.schedule(durations, resolution)
+    with hw.RegisterMapping() as regmap:
+        with hw.PerformanceCounter(regmap, [hw.CORE_PCTR_CYCLE_COUNT]) as pctr:
+            counts = counters.series(pctr, times)
+    result = counters.checkpoint_values(times, counts, durations)
+    if curve:
+        result += counters.rate(times, counts)
+    return result
+
 def cpu_random():
-        with RegisterMapping() as regmap:
-                with PerformanceCounter(regmap, [CORE_PCTR_CYCLE_COUNT]) as pctr:
+        with hw.RegisterMapping() as regmap:
+                with hw.PerformanceCounter(regmap, [hw.CORE_PCTR_CYCLE_COUNT]) as pctr:
                         a=random.random()
                         result = pctr.result()
                         return (result[0])
 
 def cpu_true_random(n):
-        with RegisterMapping() as regmap:
-                with PerformanceCounter(regmap, [CORE_PCTR_CYCLE_COUNT]) as pctr:
-                        a=os.urandom(n)
-                        result = pctr.result()
-                        return (result[0])
+    # n bytes from /dev/urandom in entropy.CHUNK pieces into one reused
+    # buffer; the total is comparable to timing os.urandom(n) as a whole
+    with cycle_counter() as pctr:
+        took = entropy.read_chunks(pctr, n)
+    total = int(took.sum())
+    return np.concatenate(([total], took)) if true_random_chunks else total
 
 def cpu_hash():
-    with RegisterMapping() as regmap:
-        with PerformanceCounter(regmap, [CORE_PCTR_CYCLE_COUNT]) as pctr:
+    with hw.RegisterMapping() as regmap:
+        with hw.PerformanceCounter(regmap, [hw.CORE_PCTR_CYCLE_COUNT]) as pctr:
             h=int(hashlib.sha256("test string".encode('utf-8')).hexdigest(), 16) % 10**8
             result = pctr.result()
             return (result[0])
 
 def cpu_fib(n):
-    with RegisterMapping() as regmap:
-        with PerformanceCounter(regmap, [CORE_PCTR_CYCLE_COUNT]) as pctr:
+    with hw.RegisterMapping() as regmap:
+        with hw.PerformanceCounter(regmap, [hw.CORE_PCTR_CYCLE_COUNT]) as pctr:
             h=fib(n)
             result = pctr.result()
             return (result[0])
 
+@contextmanager
+def cycle_counter():
+    # the counter setup of the cpu_* tests, for calibration
+    with hw.RegisterMapping() as regmap:
+        with hw.PerformanceCounter(regmap, [hw.CORE_PCTR_CYCLE_COUNT]) as pctr:
+            yield pctr
+
+def cpu_batch(op, n, *args):
+    # n repetitions of op(*args) under one counter setup; the counter setup
+    # costs more than a single hash or random.random() call.
+    took = np.zeros(n, dtype=np.int64)
+    with hw.RegisterMapping() as regmap:
+        with hw.PerformanceCounter(regmap, [hw.CORE_PCTR_CYCLE_COUNT]) as pctr:
+            for i in range(n):
+                start = np.array(pctr.result(), dtype=np.int64)
+                op(*args)
+                end = np.array(pctr.result(), dtype=np.int64)
+                took[i] = ((end - start) % counters.WRAP).sum()
+    return bench_stats.robust_stats(took)
+
+def hash_op():
+    return int(hashlib.sha256("test string".encode('utf-8')).hexdigest(), 16) % 10**8
+
 @qpu
 def qpu_summation(asm, *, num_qpus, unroll_shift, code_offset,
                   align_cond=lambda pos: pos % 512 == 170):
@@ -522,16 +565,15 @@ def summation(*, length, num_qpus=8, unroll_shift=5):
     assert length > 0
     assert length % (16 * 8 * num_qpus * (1 << unroll_shift)) == 0
 
-    with Driver(data_area_size=(length + 1024) * 4) as drv:
+    with session.pool() as drv:
 
-        code = drv.program(qpu_summation, num_qpus=num_qpus,
-                           unroll_shift=unroll_shift,
-                           code_offset=drv.code_pos // 8)
+        code = session.program(qpu_summation, num_qpus=num_qpus,
+                               unroll_shift=unroll_shift, code_offset=None)
 
         X = drv.alloc(length, dtype='uint32')
         Y = drv.alloc(16 * num_qpus, dtype='uint32')
 
-        X[:] = np.arange(length, dtype=X.dtype)
+        X[:] = fixtures.arange(length, X.dtype)
         Y.fill(0)
 
         assert sum(Y) == 0
@@ -546,7 +588,7 @@ def summation(*, length, num_qpus=8, unroll_shift=5):
         drv.execute(code, unif.addresses()[0], thread=num_qpus)
         end = time.perf_counter_ns()
 
-        assert sum(Y) % 2**32 == (length - 1) * length // 2 % 2**32
+        assert int(Y.sum(dtype=np.uint64)) % 2**32 == (length - 1) * length // 2 % 2**32
         return end - start #,length * 4 / (end - start) * 1e-6]
 
 @qpu
@@ -645,16 +687,15 @@ def scopy(*, length, num_qpus=8, unroll_shift=0):
     assert length > 0
     assert length % (16 * 8 * num_qpus * (1 << unroll_shift)) == 0
 
-    with Driver(data_area_size=(length * 2 + 1024) * 4) as drv:
+    with session.pool() as drv:
 
-        code = drv.program(qpu_scopy, num_qpus=num_qpus,
-                           unroll_shift=unroll_shift,
-                           code_offset=drv.code_pos // 8)
+        code = session.program(qpu_scopy, num_qpus=num_qpus,
+                               unroll_shift=unroll_shift, code_offset=None)
 
         X = drv.alloc(length, dtype='float32')
         Y = drv.alloc(length, dtype='float32')
 
-        X[:] = np.arange(*X.shape, dtype=X.dtype)
+        X[:] = fixtures.arange(length, X.dtype)
         Y[:] = -X
 
         assert not np.array_equal(X, Y)
@@ -758,11 +799,10 @@ def memset(*, fill, length, num_qpus=8, unroll_shift=1):
     assert length > 0
     assert length % (16 * num_qpus * (1 << unroll_shift)) == 0
 
-    with Driver(data_area_size=(length + 1024) * 4) as drv:
+    with session.pool() as drv:
 
-        code = drv.program(qpu_memset, num_qpus=num_qpus,
-                           unroll_shift=unroll_shift,
-                           code_offset=drv.code_pos // 8)
+        code = session.program(qpu_memset, num_qpus=num_qpus,
+                               unroll_shift=unroll_shift, code_offset=None)
 
         X = drv.alloc(length, dtype='uint32')
 
@@ -813,13 +853,13 @@ def qpu_clock(asm):
 
 def test_clock():
 
-    bench = BenchHelper('./libbench_helper.so')
+    bench = BenchHelper('./libbench_helper.so', strategy=wait_strategy)
 
-    with Driver() as drv:
+    with session.pool() as drv:
 
         f = pow(2, 25)
 
-        code = drv.program(qpu_clock)
+        code = session.program(qpu_clock)
         unif = drv.alloc(2, dtype = 'uint32')
         done = drv.alloc(1, dtype = 'uint32')
 
@@ -833,7 +873,7 @@ def test_clock():
             csd.dispatch(code, unif.addresses()[0])
             bench.wait_address(done)
             end = time.perf_counter_ns()
-            return [f * 5 / (end - start) / 1000 / 1000 * 4] #end - start] #, f * 5 / (end - start) / 1000 / 1000 * 4]
+            return [f * 5 / (end - start) / 1000 / 1000 * 4, bench.spins, bench.wait_ns] #end - start] #, f * 5 / (end - start) / 1000 / 1000 * 4]
 
 
 @qpu
@@ -861,12 +901,12 @@ def qpu_write_N(asm, N):
 
 def test_multiple_dispatch_delay():
 
-    bench = BenchHelper('./libbench_helper.so')
+    bench = BenchHelper('./libbench_helper.so', strategy=wait_strategy)
 
-    with Driver() as drv:
+    with session.pool() as drv:
 
         data = drv.alloc((5, 16), dtype = 'uint32')
-        code = [drv.program(lambda asm: qpu_write_N(asm, i)) for i in range(data.shape[0])]
+        code = [session.program(qpu_write_N, i) for i in range(data.shape[0])]
         unif = drv.alloc((data.shape[0], 2), dtype = 'uint32')
         done = drv.alloc(1, dtype = 'uint32')
 
@@ -884,6 +924,8 @@ def test_multiple_dispatch_delay():
         data[:] = 0
 
         naive_results = np.zeros(data.shape[0], dtype='float32')
+        # spins and ns to the first observed completion, per timed wait
+        waits = []
         with drv.compute_shader_dispatcher() as csd:
             for i in range(data.shape[0]):
                 done[:] = 0
@@ -891,6 +933,7 @@ def test_multiple_dispatch_delay():
                 csd.dispatch(code[i], unif.addresses()[i,0])
                 bench.wait_address(done)
                 end = time.perf_counter_ns()
+                waits.append((bench.spins, bench.wait_ns))
                 naive_results[i] = end - start
         assert (data == np.arange(data.shape[0]).reshape(data.shape[0],1)).all()
 
@@ -903,9 +946,11 @@ def test_multiple_dispatch_delay():
                 csd.dispatch(code[i], unif.addresses()[i,0])
                 bench.wait_address(done)
                 end = time.perf_counter_ns()
+                waits.append((bench.spins, bench.wait_ns))
                 sleep_results[i] = end - start
         assert (data == np.arange(data.shape[0]).reshape(data.shape[0],1)).all()
-        return [ref_end - ref_start,np.sum(naive_results),np.sum(sleep_results)]
+        return [ref_end - ref_start,np.sum(naive_results),np.sum(sleep_results),
+                *np.median(waits, axis=0)]
 
 @qpu
 def qpu_tmu_load_1_slot_1_qpu(asm, nops):
@@ -973,11 +1018,12 @@ def qpu_tmu_load_1_slot_1_qpu(asm, nops):
 
 def test_tmu_load_1_slot_1_qpu():
 
-    bench = BenchHelper('./libbench_helper.so')
+    bench = BenchHelper('./libbench_helper.so', strategy=wait_strategy)
     res = []
+    waits = []
     for trans in [False, True]:
 
-        with Driver() as drv:
+        with session.pool() as drv:
 
             loop = 2**15
 
@@ -995,6 +1041,9 @@ def test_tmu_load_1_slot_1_qpu():
 
             results = np.zeros((1, 10), dtype = 'float32')
 
+            # the kernel only reads X: fill it once, not in the timed loop
+            X[:] = fixtures.randn(X.shape) / X.shape[int(trans)]
+
             #fig = plt.figure()
             #ax = fig.add_subplot(1,1,1)
             #ax.set_title(f'TMU load latency (1 slot, 1 qpu, stride=({unif[2]},{unif[3]}))')
@@ -1003,13 +1052,12 @@ def test_tmu_load_1_slot_1_qpu():
 
             for nops in range(results.shape[0]):
 
-                code = drv.program(lambda asm: qpu_tmu_load_1_slot_1_qpu(asm, nops))
+                code = session.program(qpu_tmu_load_1_slot_1_qpu, nops)
 
                 for i in range(results.shape[1]):
 
                     with drv.compute_shader_dispatcher() as csd:
 
-                        X[:] = np.random.randn(*X.shape) / X.shape[int(trans)]
                         Y[:] = 0.0
                         done[:] = 0
 
@@ -1017,6 +1065,7 @@ def test_tmu_load_1_slot_1_qpu():
                         csd.dispatch(code, unif.addresses()[0], thread = 8)
                         bench.wait_address(done)
                         end = time.perf_counter_ns()
+                        waits.append((bench.spins, bench.wait_ns))
 
                         results[nops,i] = end - start
 
@@ -1026,7 +1075,8 @@ def test_tmu_load_1_slot_1_qpu():
 
                 #print('{:4}/{}\t{:.9f}'.format(nops, results.shape[0], np.sum(results[nops]) / results.shape[1]))
                 res.append(np.sum(results[nops]) / results.shape[1])
-    return res
+    # median spins and ns to completion over all the timed waits
+    return res + list(np.median(waits, axis=0))
             #ax.set_ylim(auto=True)
             #ax.set_xlim(0, results.shape[0])
             #fig.savefig(f'benchmarks/tmu_load_1_slot_1_qpu_{unif[2]}_{unif[3]}.png')
@@ -1118,11 +1168,12 @@ def qpu_tmu_load_2_slot_1_qpu(asm, nops):
 
 def test_tmu_load_2_slot_1_qpu():
 
-    bench = BenchHelper('./libbench_helper.so')
+    bench = BenchHelper('./libbench_helper.so', strategy=wait_strategy)
     res=[]
+    waits = []
     for trans, min_nops, max_nops in [(False, 0, 1), (True, 0, 1)]:
 
-        with Driver() as drv:
+        with session.pool() as drv:
 
             loop = 2**13
 
@@ -1140,6 +1191,9 @@ def test_tmu_load_2_slot_1_qpu():
 
             results = np.zeros((max_nops, 10), dtype = 'float32')
 
+            # the kernel only reads X: fill it once, not in the timed loop
+            X[:] = fixtures.randn(X.shape) / X.shape[1+int(trans)]
+
             #fig = plt.figure()
             #ax = fig.add_subplot(1,1,1)
             #ax.set_title(f'TMU load latency (2 slot, 1 qpu, stride=({unif[2]},{unif[3]}))')
@@ -1149,13 +1203,12 @@ def test_tmu_load_2_slot_1_qpu():
             #print()
             for nops in range(min_nops, results.shape[0]):
 
-                code = drv.program(lambda asm: qpu_tmu_load_2_slot_1_qpu(asm, nops))
+                code = session.program(qpu_tmu_load_2_slot_1_qpu, nops)
 
                 for i in range(results.shape[1]):
 
                     with drv.compute_shader_dispatcher() as csd:
 
-                        X[:] = np.random.randn(*X.shape) / X.shape[1+int(trans)]
                         Y[:] = 0.0
                         done[:] = 0
 
@@ -1163,6 +1216,7 @@ def test_tmu_load_2_slot_1_qpu():
                         csd.dispatch(code, unif.addresses()[0], thread = 8)
                         bench.wait_address(done)
                         end = time.perf_counter_ns()
+                        waits.append((bench.spins, bench.wait_ns))
 
                         results[nops,i] = end - start
 
@@ -1177,59 +1231,227 @@ def test_tmu_load_2_slot_1_qpu():
             #ax.set_ylim(auto=True)
             #ax.set_xlim(min_nops, max_nops)
             #fig.savefig(f'benchmarks/tmu_load_2_slot_1_qpu_{unif[2]}_{unif[3]}.png')
-    return res
-
-def getHwAddr(ifname):
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    info = fcntl.ioctl(s.fileno(), 0x8927,  struct.pack('256s', bytes(ifname, 'utf-8')[:15]))
-    return ':'.join('%02x' % b for b in info[18:24])
-
-
+    return res + list(np.median(waits, axis=0))
+
+def mac_address():
+    return telemetry.mac_address('eth0')
+
+# The legacy cpu_sleep_* columns still need a 138 s counter run (their
+# cumulative sum), so the series only saves time per sample when other
+# tasks overlap this WAIT one, i.e. with --parallel.
+SLEEPS = [1, 2, 5, 10, 120]
+TRUE_RANDOM_BYTES = 100000000
+
+def qpu_freq_task():
+    curve_columns=[]
+    if qpu_curve:
+        curve_columns=[f'qpu_mhz_{t:g}s' for t in counters.schedule(SLEEPS)]
+    return Task(get_QPU_freq_series, SLEEPS, curve=qpu_curve, kind=WAIT,
+                resources=['pctr'], imports=gpu_imports,
+                columns=[f'cpu_sleep_{d}s' for d in SLEEPS] + curve_columns, dtype='float32')
+
+def cpu_task(name, fn, op, *args):
+    # one counter reading per test, or cpu_reps of them summarised
+    if cpu_reps > 0:
+        return Task(cpu_batch, op, cpu_reps, *args, resources=['pctr'], imports=gpu_imports,
+                    columns=bench_stats.stat_columns(name), dtype='float64', overhead='pctr_read')
+    return Task(fn, *args, resources=['pctr'], imports=gpu_imports, overhead='pctr_setup')
+
+def true_random_task():
+    task = cpu_task('cpu_true_random', cpu_true_random, entropy.read, TRUE_RANDOM_BYTES)
+    if cpu_reps <= 0:
+        # chunks are milliseconds long, the counter reads around them don't matter
+        task.overhead = None
+        if true_random_chunks:
+            task.columns = ['cpu_true_random'] + [
+                f'cpu_true_random_chunk_{i}'
+                for i in range(1, len(entropy.sizes(TRUE_RANDOM_BYTES)) + 1)]
+    return task
+
+def storage_columns(op):
+    # the page-cache mode is part of the column names; cached keeps the old ones
+    mode = '' if storage_cache == 'cached' else f'{storage_cache}_'
+    return [f'storage_{op}_{mode}{i}' for i in range(1, 101)]
+
+def mmap_task():
+    if mmap_advice is None:
+        return None
+    pages = 102400 * 100 // storage_bench.mmap.PAGESIZE
+    return Task(storage_bench.mmap_read_test, "test", 102400, 100, mmap_advice,
+                kind=SHARED, resources=['storage'], overhead='perf_counter',
+                columns=[f'storage_mmap_{i}' for i in range(1, pages + 1)])
+
+# Costs are rough Pi 4 timings in seconds.
+registry = Registry('vc6')
+selection = {}
+overhead = {}
+#### GPU-CPU data
+registry.register('cpu_sleep', qpu_freq_task, cost=138)
+registry.register('cpu_hash', lambda: cpu_task('cpu_hash', cpu_hash, hash_op),
+                  cost=0.01, presets=PRESETS)
+registry.register('cpu_random', lambda: cpu_task('cpu_random', cpu_random, random.random),
+                  cost=0.01, presets=PRESETS)
+registry.register('cpu_true_random', true_random_task, cost=0.6, presets=PRESETS)
+registry.register('cpu_fib', lambda: cpu_task('cpu_fib', cpu_fib, fib, 20),
+                  cost=0.05, presets=PRESETS)
+registry.register('sgemm_rnn_naive',
+                  lambda: Task(sgemm_rnn_naive, check=sgemm_check, **sgemm_config,
+                               resources=['gpu'], imports=gpu_imports,
+                               columns=['gpu_matrixmul'], overhead='perf_counter'),
+                  boards=['vc6'], cost=1.0, presets=PRESETS)
+registry.register('summation',
+                  lambda: Task(summation, length=32 * 1024 * 1024, resources=['gpu'],
+                               imports=gpu_imports, columns=['gpu_sum'], overhead='perf_counter'),
+                  boards=['vc6'], cost=0.5, presets=PRESETS)
+registry.register('scopy',
+                  lambda: Task(scopy, length=16 * 1024 * 1024, resources=['gpu'],
+                               imports=gpu_imports, columns=['gpu_copy'], overhead='perf_counter'),
+                  boards=['vc6'], cost=0.3, presets=PRESETS)
+# Not part of any preset, --include them by name.
+registry.register('test_clock',
+                  lambda: Task(test_clock, resources=['gpu'], imports=gpu_imports, dtype='float64',
+                               columns=['gpu_clock_mhz', 'gpu_clock_spins', 'gpu_clock_wait_ns']),
+                  boards=['vc6'], cost=0.2, presets=())
+registry.register('test_multiple_dispatch_delay',
+                  lambda: Task(test_multiple_dispatch_delay, resources=['gpu'], imports=gpu_imports,
+                               columns=['gpu_dispatch_ref', 'gpu_dispatch_naive', 'gpu_dispatch_sleep',
+                                        'gpu_dispatch_spins', 'gpu_dispatch_wait_ns'],
+                               dtype='float64'),
+                  boards=['vc6'], cost=5.5, presets=())
+registry.register('test_tmu_load_1_slot_1_qpu',
+                  lambda: Task(test_tmu_load_1_slot_1_qpu, resources=['gpu'], imports=gpu_imports,
+                               columns=['gpu_tmu_1_slot', 'gpu_tmu_1_slot_trans',
+                                        'gpu_tmu_1_slot_spins', 'gpu_tmu_1_slot_wait_ns'],
+                               dtype='float64'),
+                  boards=['vc6'], cost=2.0, presets=())
+registry.register('test_tmu_load_2_slot_1_qpu',
+                  lambda: Task(test_tmu_load_2_slot_1_qpu, resources=['gpu'], imports=gpu_imports,
+                               columns=['gpu_tmu_2_slot', 'gpu_tmu_2_slot_trans',
+                                        'gpu_tmu_2_slot_spins', 'gpu_tmu_2_slot_wait_ns'],
+                               dtype='float64'),
+                  boards=['vc6'], cost=2.0, presets=())
+registry.register('sgemm_sweep',
+                  lambda: Task(sgemm_sweep, SGEMM_SWEEP, sgemm_check, resources=['gpu'],
+                               imports=gpu_imports, dtype='float64',
+                               columns=[f'gpu_sgemm_{P}x{Q}x{R}_t{thread}_{t[0]}x{t[1]}_{unit}'
+                                        for P, Q, R, thread, t in SGEMM_SWEEP
+                                        for unit in ('ns', 'gflops')]),
+                  boards=['vc6'], cost=20.0, presets=())
+#### Memory test
+registry.register('array_append',
+                  lambda: Task(array_append, kind=SHARED, resources=['memory'],
+                               columns=['memory_array_append'], overhead='perf_counter'),
+                  cost=0.01, presets=PRESETS)
+registry.register('memory_fill',
+                  lambda: Task(memory_fill_test, kind=SHARED, resources=['memory'],
+                               columns=['memory_fill'], overhead='perf_counter'),
+                  cost=0.1, presets=PRESETS)
+# Not part of any preset, --include them by name.
+registry.register('memory_latency',
+                  lambda: Task(memory_bench.latency_sweep, resources=['memory'], dtype='float64',
+                               columns=memory_bench.latency_columns()),
+                  cost=4.0, presets=())
+registry.register('memory_bandwidth',
+                  lambda: Task(memory_bench.bandwidth_sweep, resources=['memory'], dtype='float64',
+                               columns=memory_bench.bandwidth_columns()),
+                  cost=0.5, presets=())
+registry.register('memory_pressure',
+                  lambda: Task(memory_reserve, memory_limit, resources=['memory'], dtype='float64',
+                               columns=memory_pressure.pressure_columns()),
+                  cost=3.0, presets=())
+#### Storage test
+registry.register('csv_read',
+                  lambda: Task(csv_read, kind=SHARED, resources=['storage'], imports=['pandas'],
+                               columns=['storage_csv_read'], overhead='perf_counter'),
+                  cost=0.1, presets=PRESETS)
+registry.register('write_test',
+                  lambda: Task(storage_bench.write_test, "test", 102400, 100, storage_backend,
+                               storage_cache,
+                               kind=SHARED, resources=['storage'], overhead='perf_counter',
+                               columns=storage_columns('write')),
+                  cost=2.0, presets=PRESETS)
+registry.register('read_test',
+                  lambda: Task(storage_bench.read_test, "test", 102400, 100, storage_backend,
+                               storage_cache,
+                               kind=SHARED, resources=['storage'], overhead='perf_counter',
+                               columns=storage_columns('read')),
+                  cost=0.1, presets=PRESETS)
+registry.register('mmap_read_test', mmap_task, cost=0.2)
+registry.register('queue_depth_sweep',
+                  lambda: Task(storage_bench.queue_depth_features, "test_qd", cache=storage_cache,
+                               kind=SHARED, resources=['storage'], dtype='float64',
+                               columns=storage_bench.queue_depth_columns(cache=storage_cache)),
+                  cost=15.0, presets=())
+
+def features():
+    return registry.tasks(**selection)
+
+def schema():
+    columns = [('temperature', 'float32')]
+    for task in features():
+        columns += [(c, task.dtype) for c in task.columns]
+    if monitor.trace:
+        columns += [(c, 'float32') for c in thermal.COLUMNS]
+    return columns
+
+def sample():
+    mac=mac_address()
+    record={}
+
+    record['timestamp']=time.time()
+
+    record['temperature']=telemetry.temperature()
+
+    tasks=features()
+    monitor.reset()
+    for task, value in zip(tasks, scheduler.run(tasks)):
+        record.update(zip(task.columns, value if isinstance(value, (list, np.ndarray)) else [value]))
+    if overhead:
+        calibration.subtract(record, tasks, overhead)
+    if monitor.trace:
+        record.update(monitor.features())
+
+    record['label']=mac
+    return record
 
 def main():
-
+    args = collector.parse_args(features=registry.names())
+    global storage_backend, storage_cache, memory_limit, mmap_advice, qpu_curve, cpu_reps
+    global true_random_chunks, wait_strategy, selection, overhead, monitor, sgemm_config, sgemm_check
+    scheduler.cores = args.parallel
+    monitor = thermal.Thermal(args.thermal_band, args.thermal_timeout, trace=args.thermal_trace)
+    if monitor.active:
+        scheduler.gate = monitor.gate
+    storage_backend = args.storage_backend
+    storage_cache = args.storage_cache
+    memory_limit = args.memory_limit
+    mmap_advice = args.mmap_read
+    qpu_curve = args.qpu_curve
+    true_random_chunks = args.true_random_chunks
+    cpu_reps = args.cpu_reps
+    wait_strategy = args.wait_strategy
+    if args.sgemm:
+        sgemm_config = args.sgemm
+    sgemm_check = args.sgemm_check
+    selection = dict(include=args.include, exclude=args.exclude, preset=args.preset)
+    if args.list_features:
+        registry.describe()
+        return
+    if args.profile_imports:
+        lazy_imports.report(features())
     gc.disable()
-    s=120
-    r=100000000
-
-    mac=getHwAddr('eth0')
-    results=[]
-
-    results.append(time.time())
-
-    results.append(os.popen("vcgencmd measure_temp | cut -d = -f 2 | cut -d \"'\" -f 1").read()[:-1])
-
-    #### GPU-CPU data
-    results.append(get_QPU_freq(1))
-    results.append(get_QPU_freq(2))
-    results.append(get_QPU_freq(5))
-    results.append(get_QPU_freq(10))
-    results.append(get_QPU_freq(s))
-
-    results.append(cpu_hash())
-    results.append(cpu_random())
-    results.append(cpu_true_random(r))
-    results.append(cpu_fib(20))
-
-    results.append(sgemm_rnn_naive())
-    results.append(summation(length=32 * 1024 * 1024))
-    results.append(scopy(length=16 * 1024 * 1024))
-
-    #### Memory test
-    results.append(array_append())
-    results.append(memory_reserve())
-
-    #### Storage test
-    results.append(csv_read())
-    for i in write_test("test",102400,100):
-        results.append(i)
-    for i in read_test("test",102400,100):
-        results.append(i)
-
-
-
-    results.append(mac)
-    print(*results, sep=',')
+    store = collector.open_store(args, schema(), mac_address())
+    with session:
+        if args.calibrate or args.subtract_overhead:
+            medians = calibration.load_or_run(
+                args.output or '.', mac_address(),
+                lambda: calibration.calibrate(BenchHelper('./libbench_helper.so'), cycle_counter),
+                force=args.calibrate)
+            if args.subtract_overhead:
+                overhead = medians
+        collector.run(sample, samples=args.samples, burst=args.burst,
+                      cooldown=args.cooldown, gap=args.gap, store=store,
+                      max_failures=args.max_failures)
 
 if __name__ == "__main__":
     main()
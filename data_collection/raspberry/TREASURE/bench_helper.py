@@ -20,31 +20,170 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import os
 import subprocess
-from ctypes import cdll
+import _ctypes
+from ctypes import cdll, c_int, c_int64
 import numpy as np
 
-class BenchHelper(object):
+SOURCE = '''
+#include <stdint.h>
+#include <time.h>
+#include <sched.h>
 
-    def __init__(self, path = './libbench_helper.so'):
+static int64_t now_ns(void) {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (int64_t)ts.tv_sec * 1000000000 + ts.tv_nsec;
+}
+
+/* empty call, for measuring the ctypes round trip */
+void nop(void) {}
 
-        try:
-            self.lib = cdll.LoadLibrary(path)
-        except OSError:
-            subprocess.run(f'gcc -O2 -shared -fPIC -o {path} -xc -'.split(), text=True,
-                           input='''
-#include <stdint.h>
 void wait_address(uint32_t volatile * p) {
     while(p[0] == 0){}
 }
+
+/* strategy 0: pure spin, 1: spin with a CPU yield hint, 2: sleep poll_ns
+ * between polls. stats[0] = polls before completion was observed,
+ * stats[1] = ns until then. Returns -1 after timeout_ns (0: no timeout). */
+int wait_address_ex(uint32_t volatile * p, int strategy, int64_t timeout_ns,
+                    int64_t poll_ns, int64_t * stats) {
+    int64_t start = now_ns();
+    int64_t spins = 0;
+    struct timespec ts = { poll_ns / 1000000000, poll_ns % 1000000000 };
+    while (p[0] == 0) {
+        spins++;
+        if (strategy == 1) {
+#if defined(__aarch64__) || defined(__arm__)
+            __asm__ volatile("yield");
+#elif defined(__x86_64__) || defined(__i386__)
+            __asm__ volatile("pause");
+#endif
+        } else if (strategy == 2) {
+            nanosleep(&ts, 0);
+        }
+        if (timeout_ns > 0 && (strategy == 2 || (spins & 0x3ff) == 0)
+                && now_ns() - start > timeout_ns) {
+            stats[0] = spins;
+            stats[1] = now_ns() - start;
+            return -1;
+        }
+    }
+    stats[0] = spins;
+    stats[1] = now_ns() - start;
+    return 0;
+}
+
+/* Dependent loads through a chain of word indices (buf[i] is the index of
+ * the next word to visit): `warm` untimed loads, then ns for `loads`
+ * more. The final index goes to *sink so the loop can't be dropped. */
+int64_t pointer_chase(const uint64_t * buf, int64_t warm, int64_t loads, uint64_t * sink) {
+    uint64_t p = 0;
+    int64_t i, start;
+    for (i = 0; i < warm; i++)
+        p = buf[p];
+    start = now_ns();
+    for (i = 0; i < loads; i++)
+        p = buf[p];
+    start = now_ns() - start;
+    *sink = p;
+    return start;
+}
+
+/* ns for `passes` passes over buf[0..words) touching every stride-th word,
+ * reading (write == 0) or writing it. */
+int64_t stride_access(uint64_t * buf, int64_t words, int64_t stride, int64_t passes,
+                      int write, uint64_t * sink) {
+    uint64_t volatile * v = buf;
+    uint64_t sum = 0;
+    int64_t i, k, start = now_ns();
+    for (k = 0; k < passes; k++) {
+        if (write) {
+            for (i = 0; i < words; i += stride)
+                v[i] = i;
+        } else {
+            for (i = 0; i < words; i += stride)
+                sum += v[i];
+        }
+    }
+    start = now_ns() - start;
+    *sink = sum;
+    return start;
+}
 '''
-            )
+
+SYMBOLS = ['nop', 'wait_address', 'wait_address_ex', 'pointer_chase', 'stride_access']
+
+WAIT_STRATEGIES = {'spin': 0, 'yield': 1, 'poll': 2}
+
+class BenchHelper(object):
+
+    def __init__(self, path = './libbench_helper.so', strategy = 'spin', timeout = 10.0,
+                 poll_interval = 10e-6):
+
+        try:
             self.lib = cdll.LoadLibrary(path)
+            for sym in SYMBOLS:
+                getattr(self.lib, sym)
+        except OSError:
+            self.lib = self.build(path)
+        except AttributeError:
+            # Built from an older SOURCE: unload it before replacing the file.
+            _ctypes.dlclose(self.lib._handle)
+            self.lib = self.build(path)
 
 
+        self.lib.nop.argtypes = []
+        self.lib.nop.restype = None
         self.lib.wait_address.argtypes = [
             np.ctypeslib.ndpointer(dtype=np.uint32, shape=(1,), flags="C_CONTIGUOUS"),
         ]
+        self.lib.wait_address_ex.argtypes = [
+            np.ctypeslib.ndpointer(dtype=np.uint32, shape=(1,), flags="C_CONTIGUOUS"),
+            c_int, c_int64, c_int64,
+            np.ctypeslib.ndpointer(dtype=np.int64, shape=(2,), flags="C_CONTIGUOUS"),
+        ]
+        self.lib.pointer_chase.restype = c_int64
+        self.lib.pointer_chase.argtypes = [
+            np.ctypeslib.ndpointer(dtype=np.uint64, flags="C_CONTIGUOUS"),
+            c_int64, c_int64,
+            np.ctypeslib.ndpointer(dtype=np.uint64, shape=(1,), flags="C_CONTIGUOUS"),
+        ]
+        self.lib.stride_access.restype = c_int64
+        self.lib.stride_access.argtypes = [
+            np.ctypeslib.ndpointer(dtype=np.uint64, flags="C_CONTIGUOUS"),
+            c_int64, c_int64, c_int64, c_int,
+            np.ctypeslib.ndpointer(dtype=np.uint64, shape=(1,), flags="C_CONTIGUOUS"),
+        ]
+
+        self.strategy = WAIT_STRATEGIES[strategy]
+        self.timeout_ns = int(timeout * 1e9) if timeout else 0
+        self.poll_ns = int(poll_interval * 1e9)
+        self.stats = np.zeros(2, dtype=np.int64)
+        self.sink = np.zeros(1, dtype=np.uint64)
+        self.spins = 0
+        self.wait_ns = 0
+
+    @staticmethod
+    def build(path):
+        tmp = f'{path}.{os.getpid()}'
+        subprocess.run(f'gcc -O2 -shared -fPIC -o {tmp} -xc -'.split(), text=True,
+                       input=SOURCE, check=True)
+        os.replace(tmp, path)
+        return cdll.LoadLibrary(path)
 
     def wait_address(self, done):
-        self.lib.wait_address(done)
+        ret = self.lib.wait_address_ex(done, self.strategy, self.timeout_ns,
+                                       self.poll_ns, self.stats)
+        self.spins, self.wait_ns = int(self.stats[0]), int(self.stats[1])
+        if ret < 0:
+            raise TimeoutError(f'GPU did not signal completion in {self.timeout_ns * 1e-9} s')
+
+    def pointer_chase(self, chain, loads, warm=0):
+        # ns per load
+        return self.lib.pointer_chase(chain, warm, loads, self.sink) / loads
+
+    def stride_access(self, buf, stride, passes=1, write=False):
+        # ns for all the passes
+        return self.lib.stride_access(buf, len(buf), stride, passes, int(write), self.sink)
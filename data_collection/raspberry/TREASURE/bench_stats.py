@@ -0,0 +1,18 @@
+
+# Robust summary statistics for repeated measurements.
+# TREASURE PROJECT 2021
+import numpy as np
+
+QUANTILES = (0.1, 0.25, 0.75, 0.9)
+
+def stat_columns(name, quantiles=QUANTILES):
+    return [f'{name}_median', f'{name}_mad', f'{name}_min'] + \
+        [f'{name}_q{int(q * 100):02d}' for q in quantiles]
+
+def robust_stats(values, quantiles=QUANTILES):
+    # median, median absolute deviation, min and the given quantiles
+    values = np.asarray(values, dtype=np.float64)
+    median = np.median(values)
+    mad = np.median(np.abs(values - median))
+    return [float(median), float(mad), float(values.min())] + \
+        np.quantile(values, quantiles).tolist()
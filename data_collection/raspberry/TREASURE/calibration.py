@@ -0,0 +1,125 @@
+
+# Overhead of the measurement harness itself.
+# Each primitive the features are built from is timed around an empty
+# payload: a perf_counter_ns pair (every ns-timed feature), a list append,
+# a ctypes call into BenchHelper and the performance counter setup and read
+# used by the cpu_* tests. The distributions are stored next to the dataset
+# and their medians can be subtracted from the raw features of the tasks
+# that declare the primitive as their overhead.
+# TREASURE PROJECT 2021
+import json
+import os
+import time
+
+import numpy as np
+
+import bench_stats
+
+def perf_counter(n):
+    took = np.zeros(n, dtype=np.int64)
+    for i in range(n):
+        start = time.perf_counter_ns()
+        end = time.perf_counter_ns()
+        took[i] = end - start
+    return took
+
+def list_append(n):
+    took = np.zeros(n, dtype=np.int64)
+    values = []
+    for i in range(n):
+        start = time.perf_counter_ns()
+        values.append(i)
+        took[i] = time.perf_counter_ns() - start
+    return took
+
+def ctypes_call(bench, n):
+    took = np.zeros(n, dtype=np.int64)
+    nop = bench.lib.nop
+    for i in range(n):
+        start = time.perf_counter_ns()
+        nop()
+        took[i] = time.perf_counter_ns() - start
+    return took
+
+def pctr_setup(counter, n):
+    # What a cpu_* test reports for an empty payload, in counter units.
+    # counter() is a context manager around RegisterMapping and
+    # PerformanceCounter, as the test opens them, yielding the counter.
+    took = np.zeros(n, dtype=np.int64)
+    for i in range(n):
+        with counter() as pctr:
+            took[i] = sum(pctr.result())
+    return took
+
+def pctr_read(counter, n, wrap=1 << 32):
+    # cpu_batch overhead per repetition: two back-to-back result() reads
+    took = np.zeros(n, dtype=np.int64)
+    with counter() as pctr:
+        for i in range(n):
+            start = np.array(pctr.result(), dtype=np.int64)
+            end = np.array(pctr.result(), dtype=np.int64)
+            took[i] = ((end - start) % wrap).sum()
+    return took
+
+UNITS = {
+    'perf_counter': 'ns',
+    'list_append': 'ns',
+    'ctypes_call': 'ns',
+    'pctr_setup': 'cycles',
+    'pctr_read': 'cycles',
+}
+
+def calibrate(bench=None, counter=None, n=1000):
+    samples = {
+        'perf_counter': perf_counter(n),
+        'list_append': list_append(n),
+    }
+    if bench is not None:
+        samples['ctypes_call'] = ctypes_call(bench, n)
+    if counter is not None:
+        samples['pctr_setup'] = pctr_setup(counter, n)
+        samples['pctr_read'] = pctr_read(counter, n)
+    return samples
+
+def path(directory, device_id):
+    return os.path.join(directory, f'calibration_{device_id.replace(":", "_")}')
+
+def save(base, samples):
+    # <base>.json: robust statistics per primitive, <base>.npz: raw samples
+    summary = {'timestamp': time.time(), 'primitives': {}}
+    names = bench_stats.stat_columns('')
+    for name, took in samples.items():
+        stats = dict(zip((c.lstrip('_') for c in names), bench_stats.robust_stats(took)))
+        summary['primitives'][name] = dict(stats, unit=UNITS[name], samples=len(took))
+    with open(base + '.json', 'w') as f:
+        json.dump(summary, f, indent=1)
+    np.savez(base + '.npz', **samples)
+    return summary
+
+def load_or_run(directory, device_id, run, force=False):
+    # Medians of the stored calibration, measuring it with run() first if
+    # there is none yet or force is set.
+    base = path(directory, device_id)
+    if force or not os.path.exists(base + '.json'):
+        os.makedirs(directory, exist_ok=True)
+        save(base, run())
+    return medians(base)
+
+def medians(base):
+    with open(base + '.json') as f:
+        summary = json.load(f)
+    return {name: p['median'] for name, p in summary['primitives'].items()}
+
+def subtract(record, tasks, overhead):
+    # Remove the calibrated median of each task's declared primitive from
+    # its columns; spreads (the _mad columns) are left alone.
+    for task in tasks:
+        m = overhead.get(task.overhead)
+        if m is None:
+            continue
+        for column in task.columns:
+            value = record.get(column)
+            if column.endswith('_mad') or not isinstance(value, (int, float, np.number)):
+                continue
+            record[column] = int(round(value - m)) if isinstance(value, int) else value - m
+    return record
@@ -0,0 +1,181 @@
+
+# Long-lived collection loop shared by the VC4 and VC6 test scripts.
+# Runs the measurement list repeatedly inside one process instead of one
+# python3 launch per sample.
+# TREASURE PROJECT 2021
+import argparse
+import gc
+import os
+import sys
+import time
+
+import telemetry
+
+TEST_FILES = ['test']
+
+def _cores(value):
+    cores = [int(c) for c in value.split(',') if c]
+    usable = os.sched_getaffinity(0)
+    bad = [c for c in cores if c not in usable]
+    if bad:
+        raise argparse.ArgumentTypeError(
+            f'cores {",".join(map(str, bad))} not available (usable: '
+            f'{",".join(map(str, sorted(usable)))})')
+    return cores
+
+def _names(value):
+    return [n for n in value.split(',') if n]
+
+def _sgemm(value):
+    # PxQxR:THREADS:ROWSxCOLS, e.g. 512x512x512:16:4x4
+    try:
+        size, thread, tiling = value.split(':')
+        P, Q, R = (int(n) for n in size.split('x'))
+        rows, cols = (int(n) for n in tiling.split('x'))
+        return dict(P=P, Q=Q, R=R, thread=int(thread), tiling=(rows, cols))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected PxQxR:THREADS:ROWSxCOLS, got {value}')
+
+def _band(value):
+    low, high = (float(t) for t in value.split(','))
+    if low > high:
+        raise argparse.ArgumentTypeError(f'empty band {value}')
+    return low, high
+
+def parse_args(argv=None, features=None):
+    # features: the registered names --include/--exclude are checked against
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--samples', type=int, default=1,
+                        help='number of samples to collect (0 runs forever)')
+    parser.add_argument('--burst', type=int, default=0,
+                        help='samples per burst before the cool-down (0 disables)')
+    parser.add_argument('--cooldown', type=float, default=0.0,
+                        help='seconds to wait after each burst')
+    parser.add_argument('--gap', type=float, default=0.0,
+                        help='seconds to wait between two samples')
+    parser.add_argument('--max-failures', type=int, default=5, metavar='N',
+                        help='stop after N failed samples in a row (0 never stops)')
+    parser.add_argument('--parallel', type=_cores, default=[], metavar='CORES',
+                        help='spare cores for non-interfering features, e.g. 0,1,2')
+    parser.add_argument('--storage-backend', default='syscall',
+                        choices=['syscall', 'vector', 'uring'],
+                        help='I/O path used by the storage read/write tests')
+    parser.add_argument('--storage-cache', default='cached',
+                        choices=['cached', 'direct', 'dontneed'],
+                        help='page cache handling of the storage read/write tests: buffered, '
+                             'O_DIRECT, or evicted with posix_fadvise before each block')
+    parser.add_argument('--mmap-read', metavar='ADVICE',
+                        choices=['normal', 'random', 'sequential', 'dontneed'],
+                        help='also time page faults reading the test file through mmap')
+    parser.add_argument('--memory-limit', type=int, default=64, metavar='MB',
+                        help='cgroup memory limit the memory_pressure test fills twice over')
+    parser.add_argument('--qpu-curve', action='store_true',
+                        help='also output the per-second QPU clock curve of the cpu_sleep run')
+    parser.add_argument('--cpu-reps', type=int, default=0, metavar='N',
+                        help='batch N repetitions of each cpu_* test and output robust statistics')
+    parser.add_argument('--true-random-chunks', action='store_true',
+                        help='also output the counter reading of each chunk of cpu_true_random')
+    parser.add_argument('--wait-strategy', default='spin', choices=['spin', 'yield', 'poll'],
+                        help='how BenchHelper waits for GPU completion')
+    parser.add_argument('--preset', default='full', choices=['full', 'lite'],
+                        help='feature set: full enrollment vector or quick lite fingerprint')
+    parser.add_argument('--include', type=_names, default=None, metavar='NAMES',
+                        help='collect only these features, e.g. cpu_hash,memory_fill '
+                             '(see --list-features)')
+    parser.add_argument('--exclude', type=_names, default=[], metavar='NAMES',
+                        help='leave these features out')
+    parser.add_argument('--list-features', action='store_true',
+                        help='list the registered features with their cost and exit')
+    parser.add_argument('--calibrate', action='store_true',
+                        help='measure the harness overhead and store it next to the output')
+    parser.add_argument('--subtract-overhead', action='store_true',
+                        help='subtract the calibrated harness overhead from the features')
+    parser.add_argument('--sgemm', type=_sgemm, metavar='PxQxR:THREADS:ROWSxCOLS',
+                        help='matrix sizes, thread count and tiling of sgemm_rnn_naive (VC6)')
+    parser.add_argument('--sgemm-check', action='store_true',
+                        help='check the sgemm results against a cached NumPy reference')
+    parser.add_argument('--thermal-band', type=_band, metavar='LOW,HIGH',
+                        help='hold each test until the SoC temperature is in this range (C)')
+    parser.add_argument('--thermal-timeout', type=float, default=60.0, metavar='SECONDS',
+                        help='longest hold for --thermal-band before starting anyway')
+    parser.add_argument('--thermal-trace', action='store_true',
+                        help='read temperature and ARM/QPU clocks between tests and output a summary')
+    parser.add_argument('--profile-imports', action='store_true',
+                        help='report the import time of each feature on stderr before collecting')
+    parser.add_argument('--output', metavar='DIR',
+                        help='append samples to a columnar store instead of printing CSV')
+    args = parser.parse_args(argv)
+    if args.true_random_chunks and args.cpu_reps > 0:
+        parser.error('--true-random-chunks only applies to single readings, not with --cpu-reps')
+    if features is not None:
+        unknown = set(args.include or []) | set(args.exclude)
+        unknown -= set(features)
+        if unknown:
+            parser.error(f'unknown features: {", ".join(sorted(unknown))} (see --list-features)')
+    return args
+
+def drop_caches():
+    # Same effect as "sync; echo 3 > /proc/sys/vm/drop_caches"
+    os.sync()
+    try:
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3\n')
+    except OSError:
+        pass
+
+def reset_state(test_files=TEST_FILES):
+    for path in test_files:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    gc.collect()
+    drop_caches()
+
+def open_store(args, schema, device_id):
+    if not args.output:
+        return None
+    from feature_store import FeatureStore
+    # one part per burst; without bursts, the store's default chunk size
+    # (not one part per sample, which an unbounded run would pile up)
+    if args.burst > 0:
+        return FeatureStore(args.output, schema, device_id, telemetry.model(),
+                            chunk_rows=args.burst)
+    return FeatureStore(args.output, schema, device_id, telemetry.model())
+
+def run(sample, samples=1, burst=0, cooldown=0.0, gap=0.0,
+        test_files=TEST_FILES, out=sys.stdout, store=None, max_failures=5):
+    # A failed sample is reported on stderr and skipped, like a failed
+    # launch of the old one-process-per-sample runner; the run only stops
+    # after max_failures of them in a row. Returns the samples collected.
+    n = 0
+    failures = 0
+    in_a_row = 0
+    try:
+        while samples <= 0 or n < samples:
+            if n > 0:
+                reset_state(test_files)
+                if burst > 0 and n % burst == 0:
+                    time.sleep(cooldown)
+                elif gap > 0:
+                    time.sleep(gap)
+            n += 1
+            try:
+                record = sample()
+            except Exception as e:
+                failures += 1
+                in_a_row += 1
+                print(f'sample {n} failed: {type(e).__name__}: {e}', file=sys.stderr, flush=True)
+                if max_failures > 0 and in_a_row >= max_failures:
+                    raise RuntimeError(f'{in_a_row} samples failed in a row') from e
+                continue
+            in_a_row = 0
+            if store is not None:
+                store.append(record)
+            else:
+                print(*record.values(), sep=',', file=out, flush=True)
+    finally:
+        # also on Ctrl-C, so the buffered rows of the burst are kept
+        if store is not None:
+            store.close()
+    return n - failures
@@ -0,0 +1,45 @@
+
+# Time series of V3D/VC4 performance counters from a single counter run.
+# TREASURE PROJECT 2021
+import time
+
+import numpy as np
+
+# The hardware counters are 32 bits wide and wrap in a few seconds at QPU
+# clock rates, so they are read often enough to unwrap them in software.
+WRAP = 1 << 32
+
+def schedule(durations, resolution=1.0):
+    # Snapshot times: the cumulative checkpoints of back-to-back waits of the
+    # given durations, plus one every `resolution` seconds.
+    checkpoints = np.cumsum(durations, dtype=np.float64)
+    grid = np.arange(resolution, checkpoints[-1], resolution)
+    return np.union1d(grid, checkpoints)
+
+def series(pctr, times):
+    # Unwrapped cumulative counts, one row per snapshot time and one column
+    # per counter, measured from the moment series() is called.
+    start = time.perf_counter()
+    prev = np.array(pctr.result(), dtype=np.int64)
+    total = np.zeros_like(prev)
+    out = np.zeros((len(times), len(prev)), dtype=np.int64)
+    for i, t in enumerate(times):
+        time.sleep(max(0.0, start + t - time.perf_counter()))
+        cur = np.array(pctr.result(), dtype=np.int64)
+        total += (cur - prev) % WRAP
+        prev = cur
+        out[i] = total
+    return out
+
+def checkpoint_values(times, counts, durations):
+    # What a fresh counter run per duration would have returned: the count
+    # over each interval, wrapped to 32 bits per counter, summed, in millions.
+    idx = np.searchsorted(times, np.cumsum(durations, dtype=np.float64))
+    deltas = np.diff(counts[idx], axis=0, prepend=0) % WRAP
+    return (deltas.sum(axis=1) * 1e-6).tolist()
+
+def rate(times, counts):
+    # Counts per second between consecutive snapshots, in millions (MHz for
+    # the cycle counter).
+    steps = np.diff(times, prepend=0.0)
+    return (np.diff(counts.sum(axis=1), prepend=0) / steps * 1e-6).tolist()
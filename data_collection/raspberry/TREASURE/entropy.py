@@ -0,0 +1,50 @@
+
+# Entropy throughput for cpu_true_random.
+# n bytes are read from /dev/urandom in CHUNK-sized pieces into one buffer
+# allocated on first use, instead of os.urandom(n) allocating (and
+# faulting in) all n bytes on every sample. read_chunks() times each chunk
+# with a performance counter; their sum stands in for the old single
+# reading over os.urandom(n).
+# TREASURE PROJECT 2021
+import numpy as np
+
+import counters
+
+CHUNK = 1 << 20
+
+_urandom = None
+_buffer = None
+
+def _open(chunk):
+    global _urandom, _buffer
+    if _urandom is None:
+        _urandom = open('/dev/urandom', 'rb', buffering=0)
+    if _buffer is None or len(_buffer) < chunk:
+        _buffer = memoryview(bytearray(chunk))
+    return _urandom, _buffer
+
+def _fill(f, view):
+    got = f.readinto(view)
+    while got < len(view):
+        got += f.readinto(view[got:])
+
+def sizes(n, chunk=CHUNK):
+    return [chunk] * (n // chunk) + ([n % chunk] if n % chunk else [])
+
+def read(n, chunk=CHUNK):
+    # untimed, for cpu_batch
+    f, buff = _open(chunk)
+    for size in sizes(n, chunk):
+        _fill(f, buff[:size])
+
+def read_chunks(pctr, n, chunk=CHUNK):
+    # counter units per chunk, summed over the counters pctr reads
+    f, buff = _open(chunk)
+    views = [buff[:size] for size in sizes(n, chunk)]
+    took = np.zeros(len(views), dtype=np.int64)
+    for i, view in enumerate(views):
+        start = np.array(pctr.result(), dtype=np.int64)
+        _fill(f, view)
+        end = np.array(pctr.result(), dtype=np.int64)
+        took[i] = ((end - start) % counters.WRAP).sum()
+    return took
@@ -0,0 +1,71 @@
+
+# Registry of the features a test script can collect.
+# Each feature is registered once, in output order, with a function that
+# builds its Task (columns, dtype and interference class live on the Task),
+# the boards it runs on, a rough cost in seconds and the presets it is part
+# of. A build function may return None when the options it depends on leave
+# it disabled. The collected subset is then picked from the command line:
+#   full  the enrollment vector (default)
+#   lite  a quick re-identification fingerprint, well under 10 s
+# TREASURE PROJECT 2021
+import sys
+
+BOARDS = ('vc4', 'vc6')
+PRESETS = ('full', 'lite')
+
+class Feature(object):
+
+    def __init__(self, name, build, boards=BOARDS, cost=0.0, presets=('full',)):
+        self.name = name
+        self.build = build
+        self.boards = tuple(boards)
+        self.cost = cost
+        self.presets = tuple(presets)
+
+class Registry(object):
+
+    def __init__(self, board):
+        self.board = board
+        self.features = []
+
+    def register(self, name, build, boards=BOARDS, cost=0.0, presets=('full',)):
+        if any(f.name == name for f in self.features):
+            raise ValueError(f'feature {name} registered twice')
+        if self.board in boards:
+            self.features.append(Feature(name, build, boards, cost, presets))
+
+    def names(self):
+        return [f.name for f in self.features]
+
+    def select(self, include=None, exclude=(), preset='full'):
+        # include: explicit names (any preset); otherwise the preset's
+        # features. exclude is applied last. Output order is always the
+        # registration order.
+        unknown = set(include or []) | set(exclude)
+        unknown -= set(self.names())
+        if unknown:
+            raise ValueError(f'unknown features for {self.board}: {", ".join(sorted(unknown))}')
+        if preset not in PRESETS:
+            raise ValueError(f'unknown preset {preset}')
+        return [f for f in self.features
+                if (f.name in include if include else preset in f.presets)
+                and f.name not in exclude]
+
+    def tasks(self, include=None, exclude=(), preset='full'):
+        tasks = []
+        for f in self.select(include, exclude, preset):
+            task = f.build()
+            if task is not None:
+                task.name = f.name
+                tasks.append(task)
+        return tasks
+
+    def describe(self, out=sys.stdout):
+        for f in self.features:
+            task = f.build()
+            kind, columns = (task.kind, len(task.columns)) if task is not None else ('off', 0)
+            print(f'{f.name:<28}{f.cost:8.2f} s  {kind:<10}{columns:5d} cols  '
+                  f'{",".join(f.presets) or "-"}', file=out)
+        for preset in PRESETS:
+            cost = sum(f.cost for f in self.select(preset=preset))
+            print(f'preset {preset}: ~{cost:.0f} s', file=out)
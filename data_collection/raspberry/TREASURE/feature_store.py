@@ -0,0 +1,106 @@
+
+# Columnar output store for collected samples.
+# Each flush writes one chunk (Parquet when pyarrow is available, otherwise
+# an uncompressed .npz) into a directory, next to a schema.json describing
+# the columns, so analysis can load only the columns it needs.
+# TREASURE PROJECT 2021
+import json
+import os
+import time
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+META = [('timestamp', 'float64'), ('device_id', 'str'), ('board', 'str')]
+
+def _missing(dtype):
+    if dtype == 'str':
+        return ''
+    if np.issubdtype(np.dtype(dtype), np.integer):
+        return -1
+    return np.nan
+
+class FeatureStore(object):
+
+    def __init__(self, path, schema, device_id, board, chunk_rows=20, format=None):
+        # schema: [(column, dtype)] for the feature columns, in output order.
+        self.path = path
+        self.schema = META + [c for c in schema if c[0] not in dict(META)]
+        self.device_id = device_id
+        self.board = board
+        self.chunk_rows = chunk_rows
+        self.format = format or ('parquet' if pa is not None else 'npz')
+        self.rows = []
+        os.makedirs(path, exist_ok=True)
+        self._write_schema()
+
+    def _write_schema(self):
+        file = os.path.join(self.path, 'schema.json')
+        if os.path.exists(file):
+            with open(file) as f:
+                old = json.load(f)
+            if [tuple(c) for c in old['columns']] != self.schema:
+                raise ValueError(f'{self.path} was written with a different schema')
+            return
+        with open(file, 'w') as f:
+            json.dump({'columns': self.schema, 'format': self.format,
+                       'device_id': self.device_id, 'board': self.board}, f, indent=1)
+
+    def append(self, record):
+        row = dict(record, device_id=self.device_id, board=self.board)
+        self.rows.append(row)
+        if len(self.rows) >= self.chunk_rows:
+            self.flush()
+
+    def _columns(self):
+        columns = {}
+        for name, dtype in self.schema:
+            values = [row.get(name) for row in self.rows]
+            values = [_missing(dtype) if v is None or v == '' else v for v in values]
+            columns[name] = np.array(values, dtype=str if dtype == 'str' else dtype)
+        return columns
+
+    def flush(self):
+        if not self.rows:
+            return
+        columns = self._columns()
+        name = os.path.join(self.path, f'part-{time.time_ns()}-{os.getpid()}')
+        if self.format == 'parquet':
+            pq.write_table(pa.table(columns), name + '.parquet')
+        else:
+            np.savez(name + '.npz', **columns)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, value, traceback):
+        self.close()
+        return False
+
+def load(path, columns=None):
+    import pandas as pd
+
+    with open(os.path.join(path, 'schema.json')) as f:
+        schema = json.load(f)
+    names = columns or [c[0] for c in schema['columns']]
+    parts = sorted(f for f in os.listdir(path) if f.startswith('part-'))
+    frames = []
+    for part in parts:
+        file = os.path.join(path, part)
+        if part.endswith('.parquet'):
+            frames.append(pd.read_parquet(file, columns=names))
+        else:
+            with np.load(file) as npz:
+                frames.append(pd.DataFrame({n: npz[n] for n in names}))
+    if not frames:
+        return pd.DataFrame(columns=names)
+    return pd.concat(frames, ignore_index=True)
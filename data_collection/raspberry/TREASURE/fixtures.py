@@ -0,0 +1,44 @@
+
+# Deterministic input data for the GPU tests.
+# Each array is generated once, saved as a .npy file in DIR named after
+# what it holds, its shape, dtype and seed, and memory-mapped read-only
+# from then on. The tests copy from the fixtures into their driver
+# buffers instead of running the RNG (or np.arange) on every sample.
+# TREASURE PROJECT 2021
+import os
+
+import numpy as np
+
+DIR = 'fixtures'
+
+# key -> memory-mapped array, for the lifetime of the process
+_arrays = {}
+
+def key(kind, shape, dtype, seed=None):
+    shape = 'x'.join(str(n) for n in shape)
+    seed = '' if seed is None else f'_seed{seed}'
+    return f'{kind}_{shape}_{np.dtype(dtype).name}{seed}'
+
+def get(kind, shape, dtype, seed, generate):
+    # generate() builds the array the first time it is needed
+    name = key(kind, shape, dtype, seed)
+    if name not in _arrays:
+        path = os.path.join(DIR, name + '.npy')
+        if not os.path.exists(path):
+            array = np.asarray(generate(), dtype=dtype)
+            assert array.shape == tuple(shape)
+            os.makedirs(DIR, exist_ok=True)
+            tmp = f'{path}.{os.getpid()}.tmp'
+            with open(tmp, 'wb') as f:
+                np.save(f, array)
+            os.replace(tmp, path)
+        _arrays[name] = np.load(path, mmap_mode='r')
+    return _arrays[name]
+
+def randn(shape, dtype='float32', seed=0):
+    shape = tuple(shape)
+    return get('randn', shape, dtype, seed,
+               lambda: np.random.RandomState(seed).randn(*shape))
+
+def arange(length, dtype='uint32'):
+    return get('arange', (length,), dtype, None, lambda: np.arange(length, dtype=dtype))
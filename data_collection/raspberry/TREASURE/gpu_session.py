@@ -0,0 +1,59 @@
+
+# One GPU driver per process, shared by every test.
+# Opening the mailbox/DRM handles and mapping GPU memory is more expensive
+# than most of the short tests, so the driver is opened once with a data
+# area sized for the biggest test and each test borrows it through pool().
+# TREASURE PROJECT 2021
+from contextlib import contextmanager
+
+class GPUSession(object):
+
+    def __init__(self, backend, **driver_args):
+        # backend: a hal back-end; its Driver and kernel cache are only
+        # looked up when the session is first used.
+        self.backend = backend
+        self.driver_args = driver_args
+        self.drv = None
+        self.code = {}
+
+    def open(self):
+        if self.drv is None:
+            self.drv = self.backend.Driver(**self.driver_args)
+        return self.drv
+
+    def close(self):
+        if self.drv is not None:
+            self.drv.close()
+            self.drv = None
+            self.code.clear()
+
+    def __enter__(self):
+        # the driver itself is opened by the first test that uses it
+        return self
+
+    def __exit__(self, exc_type, value, traceback):
+        self.close()
+        return False
+
+    @contextmanager
+    def pool(self):
+        # Sub-allocations made with drv.alloc() inside the block are handed
+        # back when it exits by rewinding the driver's bump allocator.
+        drv = self.open()
+        mark = drv.data_pos
+        try:
+            yield drv
+        finally:
+            drv.data_pos = mark
+
+    def program(self, kernel, *args, **kwargs):
+        # Programs stay resident in the code area for the whole session.
+        # code_offset=None places the kernel at the current code position,
+        # which is what the alignment-sensitive kernels expect.
+        key = self.backend.kernels.key(kernel, *args, **kwargs)
+        if key not in self.code:
+            drv = self.open()
+            if kwargs.get('code_offset', 0) is None:
+                kwargs['code_offset'] = drv.code_pos // 8
+            self.code[key] = self.backend.kernels.program(drv, kernel, *args, **kwargs)
+        return self.code[key]
@@ -0,0 +1,85 @@
+
+# Device back-end selection for the test scripts.
+# A back-end bundles everything the scripts use from the GPU stack: the
+# Driver (alloc, program, execute, dispatch), the performance counters, the
+# @qpu decorator and the kernel cache. TREASURE_BACKEND=sim selects the NumPy
+# simulator in qpu_sim.py so the scripts run on hosts without a VideoCore.
+# lazy() defers loading the back-end until a feature first touches it.
+# TREASURE PROJECT 2021
+import functools
+import os
+
+from qpu_cache import KernelCache
+
+BACKENDS = ('hw', 'sim')
+
+MODULES = {
+    'vc6': ['videocore6.driver', 'videocore6.assembler', 'videocore6.v3d'],
+    'vc4': ['rpi_vcsm', 'videocore.driver', 'videocore.assembler', 'videocore.v3d'],
+}
+
+class Backend(object):
+
+    def __init__(self, name, **attrs):
+        self.name = name
+        self.__dict__.update(attrs)
+
+def backend_name():
+    name = os.environ.get('TREASURE_BACKEND', 'hw')
+    if name not in BACKENDS:
+        raise ValueError(f'TREASURE_BACKEND must be one of {BACKENDS}')
+    return name
+
+def modules(board):
+    # What the back-end imports, for Task(imports=...)
+    return ['qpu_sim'] if backend_name() == 'sim' else MODULES[board]
+
+def load(board):
+    # board: 'vc6' (Pi 4, py-videocore6) or 'vc4' (Pi Zero/1/2/3, py-videocore)
+    if backend_name() == 'sim':
+        import qpu_sim
+        return qpu_sim.backend(board)
+
+    if board == 'vc6':
+        from videocore6.v3d import RegisterMapping, PerformanceCounter, CORE_PCTR_CYCLE_COUNT
+        from videocore6 import pack_unpack
+        from videocore6.driver import Driver
+        from videocore6.assembler import qpu, assemble
+        return Backend('vc6', Driver=Driver, RegisterMapping=RegisterMapping,
+                       PerformanceCounter=PerformanceCounter,
+                       CORE_PCTR_CYCLE_COUNT=CORE_PCTR_CYCLE_COUNT,
+                       pack_unpack=pack_unpack, qpu=qpu,
+                       kernels=KernelCache(assemble))
+
+    if board == 'vc4':
+        import rpi_vcsm
+        from videocore.v3d import RegisterMapping, PerformanceCounter
+        from videocore.driver import Driver
+        from videocore.assembler import qpu, assemble
+        return Backend('vc4', Driver=Driver, RegisterMapping=RegisterMapping,
+                       PerformanceCounter=PerformanceCounter, rpi_vcsm=rpi_vcsm,
+                       qpu=qpu, kernels=KernelCache(assemble, raw=True))
+
+    raise ValueError(f'unknown board {board}')
+
+class LazyBackend(object):
+
+    def __init__(self, board):
+        self.board = board
+        self.backend = None
+
+    def __getattr__(self, name):
+        # only called for attributes the proxy itself doesn't have
+        if self.backend is None:
+            self.backend = load(self.board)
+        return getattr(self.backend, name)
+
+    def kernel(self, func):
+        # @qpu that leaves the back-end's decorator to the first assembly
+        @functools.wraps(func)
+        def assemble(asm, *args, **kwargs):
+            return self.qpu(func)(asm, *args, **kwargs)
+        return assemble
+
+def lazy(board):
+    return LazyBackend(board)
@@ -0,0 +1,44 @@
+
+# Deferred imports for the features.
+# Heavy modules (pandas, psutil, the videocore stack) are imported when a
+# feature that needs them is about to run, not when the script starts, and
+# the first import of each one is timed for --profile-imports.
+# TREASURE PROJECT 2021
+import importlib
+import os
+import sys
+import time
+
+# module -> seconds its first import took (0.0 if already loaded by another)
+TIMES = {}
+
+def load(name):
+    if name not in TIMES:
+        start = time.perf_counter()
+        fresh = name not in sys.modules
+        importlib.import_module(name)
+        TIMES[name] = time.perf_counter() - start if fresh else 0.0
+    return sys.modules[name]
+
+def startup():
+    # Seconds since the interpreter was launched (clock-tick resolution).
+    with open('/proc/self/stat') as f:
+        ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+    return time.clock_gettime(time.CLOCK_BOOTTIME) - ticks / os.sysconf('SC_CLK_TCK')
+
+def report(tasks, out=sys.stderr):
+    # Import cost charged to each feature, in run order. A module shared by
+    # several features is charged to the first one.
+    print(f'{"startup":<24}{startup() * 1e3:9.1f} ms', file=out)
+    total = 0.0
+    charged = set()
+    for task in tasks:
+        took = 0.0
+        for name in task.imports:
+            load(name)
+            if name not in charged:
+                took += TIMES[name]
+                charged.add(name)
+        total += took
+        print(f'{task.name:<24}{took * 1e3:9.1f} ms  {" ".join(task.imports)}', file=out)
+    print(f'{"total":<24}{total * 1e3:9.1f} ms', file=out, flush=True)
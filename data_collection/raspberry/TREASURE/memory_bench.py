@@ -0,0 +1,72 @@
+
+# Cache and DRAM timing, measured in the native loops of BenchHelper.
+#   latency_sweep    random pointer chase, one node per cache line, over
+#                    working sets from 4 KB to 256 MB: ns per dependent load
+#                    (the steps show the L1, L2 and DRAM latencies)
+#   bandwidth_sweep  strided reads and writes over a buffer bigger than the
+#                    caches: MB/s of the words actually touched
+# Working sets that don't fit in half of the free memory are skipped (NaN),
+# so every board outputs the same columns.
+# TREASURE PROJECT 2021
+import os
+
+import numpy as np
+
+from bench_helper import BenchHelper
+
+LINE = 64
+CHASE_SIZES = [4096 << i for i in range(17)]
+CHASE_LOADS = 1 << 21
+BANDWIDTH_SIZE = 64 << 20
+# in 8-byte words: 8 B .. 512 B
+STRIDES = (1, 2, 4, 8, 16, 32, 64)
+
+def human(size):
+    for unit in ('k', 'm'):
+        size //= 1024
+        if size < 1024:
+            break
+    return f'{size}{unit}'
+
+def fits(size):
+    return size <= os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // 2
+
+def chase_chain(size, seed=0):
+    # One random cycle through all the cache lines of the working set,
+    # stored in the first word of each line.
+    step = LINE // 8
+    chain = np.zeros(size // 8, dtype=np.uint64)
+    order = np.random.RandomState(seed).permutation(size // LINE).astype(np.uint64) * step
+    chain[order] = np.roll(order, -1)
+    return chain
+
+def latency_sweep(bench=None, sizes=CHASE_SIZES, loads=CHASE_LOADS):
+    bench = bench or BenchHelper('./libbench_helper.so')
+    result = np.full(len(sizes), np.nan)
+    for i, size in enumerate(sizes):
+        if not fits(size):
+            continue
+        chain = chase_chain(size)
+        # one lap around the chain first, to load the caches and TLB
+        result[i] = bench.pointer_chase(chain, loads, warm=min(size // LINE, loads))
+        del chain
+    return result
+
+def bandwidth_sweep(bench=None, size=BANDWIDTH_SIZE, strides=STRIDES):
+    # Returns [read MB/s per stride..., write MB/s per stride...]
+    bench = bench or BenchHelper('./libbench_helper.so')
+    result = np.full((2, len(strides)), np.nan)
+    if not fits(size):
+        return result.ravel()
+    buf = np.ones(size // 8, dtype=np.uint64)
+    for j, write in enumerate((False, True)):
+        for k, stride in enumerate(strides):
+            words = (len(buf) + stride - 1) // stride
+            result[j, k] = words * 8 / bench.stride_access(buf, stride, write=write) * 1e3
+    return result.ravel()
+
+def latency_columns(sizes=CHASE_SIZES):
+    return [f'memory_latency_{human(size)}' for size in sizes]
+
+def bandwidth_columns(strides=STRIDES):
+    return [f'memory_bw_{op}_stride{stride * 8}' for op in ('read', 'write') for stride in strides]
@@ -0,0 +1,117 @@
+
+# Fault-in and reclaim latency under a memory limit.
+# A forked child joins a memory cgroup (v2 memory.max or v1
+# memory.limit_in_bytes) and maps anonymous chunks until it has asked for
+# twice the limit, timing the first touch of every page of each chunk.
+# Past the limit each chunk has to wait for reclaim/swap-out (or the child
+# is OOM-killed, memory_pressure_oom is 1 and the chunks it didn't reach
+# stay NaN). Any other failure of the child raises. Without a writable
+# cgroup the chunks are mapped from a file on tmpfs instead, with no
+# limit: the fault path still shows, the reclaim stalls don't.
+# TREASURE PROJECT 2021
+import mmap
+import multiprocessing
+import os
+import signal
+
+import numpy as np
+
+from bench_helper import BenchHelper
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+NAME = 'mem-fingerprint'
+TMPFS = '/dev/shm'
+CHUNKS = 32
+# memory_pressure_mode column
+MODES = {'tmpfs': 0, 'cgroup1': 1, 'cgroup2': 2}
+
+class MemoryCgroup(object):
+
+    def __init__(self, name=NAME, root=CGROUP_ROOT):
+        if os.path.exists(os.path.join(root, 'cgroup.controllers')):
+            self.mode = 'cgroup2'
+            self.path = os.path.join(root, name)
+            self.limit_file = 'memory.max'
+        else:
+            self.mode = 'cgroup1'
+            self.path = os.path.join(root, 'memory', name)
+            self.limit_file = 'memory.limit_in_bytes'
+
+    def _write(self, name, value):
+        with open(os.path.join(self.path, name), 'w') as f:
+            f.write(f'{value}\n')
+
+    def create(self, limit):
+        # limit in bytes; raises OSError when cgroups aren't writable
+        os.makedirs(self.path, exist_ok=True)
+        try:
+            self._write(self.limit_file, limit)
+        except OSError:
+            # e.g. cgroup v2 without the memory controller delegated: don't
+            # leave the empty cgroup behind
+            self.remove()
+            raise
+
+    def add(self, pid):
+        self._write('cgroup.procs', pid)
+
+    def remove(self):
+        try:
+            os.rmdir(self.path)
+        except OSError:
+            pass
+
+def _fill(cgroup, chunk, took):
+    # child: took[i] = ns to fault in chunk i
+    if cgroup is not None:
+        cgroup.add(os.getpid())
+    bench = BenchHelper('./libbench_helper.so')
+    stride = mmap.PAGESIZE // 8
+    chunks = []
+    for i in range(len(took)):
+        if cgroup is None:
+            fd, path = _tmpfs_file(chunk)
+            mm = mmap.mmap(fd, chunk)
+            os.close(fd)
+            os.remove(path)
+        else:
+            mm = mmap.mmap(-1, chunk, flags=mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS)
+        chunks.append(mm)
+        took[i] = bench.stride_access(np.frombuffer(mm, dtype=np.uint64), stride, write=True)
+
+def _tmpfs_file(size):
+    path = os.path.join(TMPFS, f'{NAME}-{os.getpid()}')
+    fd = os.open(path, os.O_CREAT | os.O_RDWR | os.O_TRUNC, 0o600)
+    os.ftruncate(fd, size)
+    return fd, path
+
+def pressure_test(limit_mb=64, chunks=CHUNKS):
+    # Returns [mode, oom, ns per chunk...]; NaN for the chunks never mapped.
+    chunk = limit_mb * 2 * 1024 * 1024 // chunks
+    chunk -= chunk % mmap.PAGESIZE
+    cgroup = MemoryCgroup()
+    try:
+        cgroup.create(limit_mb * 1024 * 1024)
+    except OSError:
+        cgroup = None
+    mode = cgroup.mode if cgroup is not None else 'tmpfs'
+
+    # shared with the child, so a child killed halfway still reports
+    shared = mmap.mmap(-1, chunks * 8)
+    took = np.frombuffer(shared, dtype=np.float64)
+    took[:] = np.nan
+    proc = multiprocessing.get_context('fork').Process(target=_fill, args=(cgroup, chunk, took))
+    proc.start()
+    proc.join()
+    if cgroup is not None:
+        cgroup.remove()
+    result = np.array([MODES[mode], proc.exitcode == -signal.SIGKILL, *took])
+    del took
+    shared.close()
+    if proc.exitcode not in (0, -signal.SIGKILL):
+        raise RuntimeError(f'memory_pressure child failed with exit code {proc.exitcode}')
+    return result
+
+def pressure_columns(chunks=CHUNKS):
+    return ['memory_pressure_mode', 'memory_pressure_oom'] + \
+        [f'memory_pressure_chunk_{i}' for i in range(1, chunks + 1)]
@@ -0,0 +1,118 @@
+
+# On-disk cache of assembled QPU programs.
+# The @qpu assembler runs in Python and takes a noticeable share of each
+# sample on a Pi Zero/3, so the instruction words are stored once per
+# (kernel, parameters, assembler version) and loaded directly afterwards.
+# TREASURE PROJECT 2021
+import hashlib
+import os
+import sys
+
+import numpy as np
+
+def _code_hash(h, code):
+    # Nested code objects (comprehensions, lambdas) are hashed by their
+    # bytecode: their repr holds a memory address that changes every run.
+    h.update(code.co_code)
+    h.update(repr(code.co_names).encode())
+    for c in code.co_consts:
+        if hasattr(c, 'co_code'):
+            _code_hash(h, c)
+        elif isinstance(c, frozenset):
+            # set literal order depends on the string hash seed
+            h.update(repr(sorted(map(repr, c))).encode())
+        else:
+            h.update(repr(c).encode())
+
+def _names(code):
+    yield from code.co_names
+    for c in code.co_consts:
+        if hasattr(c, 'co_code'):
+            yield from _names(c)
+
+def _default_id(v, seen):
+    if getattr(getattr(v, '__wrapped__', v), '__code__', None) is not None:
+        return _callable_id(v, seen)
+    return repr(v)
+
+def _callable_id(f, seen=None):
+    # Also covers the helpers the kernel calls (load_params and the like):
+    # functions of the same module it names, followed recursively.
+    f = getattr(f, '__wrapped__', f)
+    code = getattr(f, '__code__', None)
+    h = hashlib.sha1(f'{f.__module__}.{f.__qualname__}'.encode())
+    if code is None:
+        return h.hexdigest()[:16]
+    seen = set() if seen is None else seen
+    seen.add(f)
+    _code_hash(h, code)
+    # defaults (nops=..., align_cond=lambda ...) change the program too
+    for v in f.__defaults__ or ():
+        h.update(_default_id(v, seen).encode())
+    for k, v in sorted((f.__kwdefaults__ or {}).items()):
+        h.update(f'{k}={_default_id(v, seen)}'.encode())
+    scope = getattr(f, '__globals__', {})
+    for name in sorted(set(_names(code))):
+        g = getattr(scope.get(name), '__wrapped__', scope.get(name))
+        if g in seen or getattr(g, '__code__', None) is None \
+                or getattr(g, '__module__', None) != f.__module__:
+            continue
+        h.update(_callable_id(g, seen).encode())
+    return h.hexdigest()[:16]
+
+def _key_value(v):
+    if callable(v):
+        return _callable_id(v)
+    return repr(v)
+
+def assembler_version(assemble):
+    module = sys.modules.get(assemble.__module__)
+    path = getattr(module, '__file__', None)
+    if path is None:
+        return 'unknown'
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()[:16]
+
+class KernelCache(object):
+
+    def __init__(self, assemble, path='./qpu_cache', raw=False):
+        # raw: the assembler returns bytes (py-videocore) instead of a list of
+        # 64-bit instruction words (py-videocore6).
+        self.assemble_fn = assemble
+        self.path = path
+        self.raw = raw
+        self.version = assembler_version(assemble)
+        self.memo = {}
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, kernel, *args, **kwargs):
+        h = hashlib.sha1(self.version.encode())
+        h.update(_callable_id(kernel).encode())
+        for v in args:
+            h.update(_key_value(v).encode())
+        for k in sorted(kwargs):
+            h.update(f'{k}={_key_value(kwargs[k])}'.encode())
+        name = getattr(kernel, '__name__', 'kernel')
+        return f'{name}-{h.hexdigest()[:20]}'
+
+    def assemble(self, kernel, *args, **kwargs):
+        key = self.key(kernel, *args, **kwargs)
+        if key in self.memo:
+            return self.memo[key]
+
+        file = os.path.join(self.path, key + '.bin')
+        words = np.fromfile(file, dtype=np.uint64) if os.path.exists(file) else None
+        if words is None or words.size == 0:
+            code = self.assemble_fn(kernel, *args, **kwargs)
+            words = np.frombuffer(code, dtype=np.uint64) if self.raw \
+                else np.array(code, dtype=np.uint64)
+            tmp = f'{file}.{os.getpid()}'
+            words.tofile(tmp)
+            os.replace(tmp, file)
+
+        code = words.tobytes() if self.raw else words
+        self.memo[key] = code
+        return code
+
+    def program(self, drv, kernel, *args, **kwargs):
+        return drv.program(self.assemble(kernel, *args, **kwargs))
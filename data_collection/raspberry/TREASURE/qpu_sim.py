@@ -0,0 +1,377 @@
+
+# NumPy simulator for the GPU back-end (TREASURE_BACKEND=sim).
+# It follows the py-videocore6/py-videocore Driver interface closely enough
+# for the test scripts: one flat memory area with GPU-style addresses,
+# alloc/copy/program/execute/compute_shader_dispatcher, and a free-running
+# cycle counter behind RegisterMapping/PerformanceCounter. Kernels are not
+# assembled; execute() looks the kernel up by name and computes its result
+# with NumPy, then waits out the time the timing model assigns to it.
+# TREASURE PROJECT 2021
+import os
+import struct
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import numpy as np
+
+from qpu_cache import KernelCache
+
+class TimingModel(object):
+
+    def __init__(self, clock_mhz=500.0, bandwidth_gbs=4.0, gflops=16.0,
+                 dispatch_us=50.0, tmu_latency=30, scale=1.0):
+        # scale multiplies every modelled duration; 0 runs as fast as NumPy
+        # allows, which is what CI wants.
+        self.clock_mhz = clock_mhz
+        self.bandwidth_gbs = bandwidth_gbs
+        self.gflops = gflops
+        self.dispatch_us = dispatch_us
+        self.tmu_latency = tmu_latency
+        self.scale = scale
+
+    @classmethod
+    def from_env(cls, value=None):
+        # TREASURE_SIM_TIMING="clock_mhz=600,bandwidth_gbs=2,scale=0"
+        value = os.environ.get('TREASURE_SIM_TIMING', '') if value is None else value
+        params = {}
+        for item in filter(None, value.split(',')):
+            k, v = item.split('=')
+            params[k.strip()] = float(v)
+        return cls(**params)
+
+    def duration(self, nbytes=0, flops=0, cycles=0):
+        return (self.dispatch_us * 1e-6 + nbytes / (self.bandwidth_gbs * 1e9) +
+                flops / (self.gflops * 1e9) + cycles / (self.clock_mhz * 1e6)) * self.scale
+
+    def wait(self, start, seconds):
+        # Sleep for what is left of the modelled duration after the NumPy work.
+        left = start + seconds - time.perf_counter()
+        if left > 0:
+            time.sleep(left)
+
+timing = TimingModel.from_env()
+
+################################################################################
+# Memory
+
+BASE = 0xc0000000
+
+class SimArray(np.ndarray):
+
+    def __new__(cls, drv, shape, dtype, offset):
+        obj = np.ndarray.__new__(cls, shape, dtype, buffer=drv.memory, offset=offset)
+        obj.drv = drv
+        return obj
+
+    def __array_finalize__(self, obj):
+        self.drv = getattr(obj, 'drv', None)
+
+    @property
+    def address(self):
+        return BASE + self.ctypes.data - self.drv.memory.ctypes.data
+
+    def addresses(self):
+        return _Addresses(self)
+
+    # py-videocore cache maintenance, nothing to do here
+    def clean(self):
+        pass
+
+    def invalidate(self):
+        pass
+
+class _Addresses(object):
+    # Indexable like the address array the real drivers return, without
+    # materialising one entry per element of a 128 MB buffer.
+
+    def __init__(self, arr):
+        self.arr = arr
+
+    def __getitem__(self, idx):
+        idx = idx if isinstance(idx, tuple) else (idx,)
+        sub = self.arr[idx + (Ellipsis,)]
+        out = np.full(sub.shape, sub.address, dtype=np.int64)
+        for axis, (n, stride) in enumerate(zip(sub.shape, sub.strides)):
+            shape = [1] * sub.ndim
+            shape[axis] = n
+            out += (np.arange(n, dtype=np.int64) * stride).reshape(shape)
+        out = out.astype(np.uint32)
+        return out[()] if out.ndim == 0 else out
+
+class SimProgram(object):
+
+    def __init__(self, kernel, args, kwargs):
+        self.name = getattr(kernel, '__name__', 'kernel')
+        self.args = args
+        self.kwargs = kwargs
+
+class SimCode(object):
+
+    def __init__(self, program, address):
+        self.program = program
+        self.address = address
+
+    def addresses(self):
+        return np.array([self.address], dtype=np.uint32)
+
+class SimDriver(object):
+
+    def __init__(self, data_area_size=32 * 1024 * 1024, code_area_size=16 * 1024 * 1024):
+        self.memory = np.zeros(data_area_size, dtype=np.uint8)
+        self.data_pos = 0
+        self.code_pos = 0
+        self.code_area_size = code_area_size
+
+    def close(self):
+        self.memory = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, value, traceback):
+        self.close()
+        return False
+
+    def alloc(self, shape, dtype='float32'):
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape)) * dtype.itemsize
+        if self.data_pos + size > self.memory.size:
+            raise MemoryError('simulated data area exhausted')
+        arr = SimArray(self, shape, dtype, self.data_pos)
+        self.data_pos += (size + 255) // 256 * 256
+        return arr
+
+    def copy(self, arr):
+        out = self.alloc(arr.shape, arr.dtype)
+        out[:] = arr
+        return out
+
+    def program(self, program):
+        # one 16-instruction slot per program, enough to hand out addresses
+        code = SimCode(program, BASE + self.code_pos)
+        self.code_pos += 16 * 8
+        return code
+
+    def view(self, address, shape, dtype, strides=None):
+        dtype = np.dtype(dtype)
+        return np.ndarray(shape, dtype, buffer=self.memory,
+                          offset=int(address) - BASE, strides=strides)
+
+    def uniforms(self, address, n):
+        return self.view(address, n, 'uint32')
+
+    def run(self, code, *args, **kwargs):
+        start = time.perf_counter()
+        kernel = KERNELS.get(code.program.name)
+        cost = kernel(self, code.program, *args, **kwargs) if kernel else {}
+        timing.wait(start, timing.duration(**cost))
+
+class V3DDriver(SimDriver):
+    # py-videocore6 calling convention
+
+    def execute(self, code, uniforms, thread=1, timeout_sec=10):
+        self.run(code, uniforms, thread)
+
+    @contextmanager
+    def compute_shader_dispatcher(self, timeout_sec=10):
+        # Dispatches run to completion before returning, so a done flag
+        # written by the kernel is already set when dispatch() returns.
+        yield SimpleNamespace(
+            dispatch=lambda code, uniforms=None, workgroup=(16, 1, 1), wgs_per_sg=16, thread=1:
+                self.run(code, uniforms, thread))
+
+class VC4Driver(SimDriver):
+    # py-videocore calling convention
+
+    def execute(self, n_threads, program, uniforms=None, timeout=10000):
+        if uniforms is not None and not isinstance(uniforms, SimArray):
+            uniforms = self.copy(np.array(uniforms, dtype=np.uint32).reshape(n_threads, -1))
+        self.run(program, n_threads, uniforms)
+
+################################################################################
+# Kernels, by @qpu function name
+
+def _as_float(word):
+    return struct.unpack('f', struct.pack('I', int(word)))[0]
+
+def _summation(drv, prog, unif, thread):
+    length, src, dst = drv.uniforms(unif, 3)
+    lanes = 16 * prog.kwargs['num_qpus']
+    X = drv.view(src, (length // lanes, lanes), 'uint32')
+    drv.view(dst, lanes, 'uint32')[:] = X.sum(axis=0, dtype=np.uint32)
+    return dict(nbytes=4 * int(length))
+
+def _scopy(drv, prog, unif, thread):
+    length, src, dst = drv.uniforms(unif, 3)
+    drv.view(dst, length, 'uint32')[:] = drv.view(src, length, 'uint32')
+    return dict(nbytes=8 * int(length))
+
+def _memset(drv, prog, unif, thread):
+    dst, fill, length = drv.uniforms(unif, 3)
+    drv.view(dst, length, 'uint32')[:] = fill
+    return dict(nbytes=4 * int(length))
+
+def _sgemm(drv, P, Q, R, A, A_stride, B, B_stride, C, C_stride, alpha, beta):
+    A = drv.view(A, (P, Q), 'float32', (A_stride, 4))
+    B = drv.view(B, (Q, R), 'float32', (B_stride, 4))
+    C = drv.view(C, (P, R), 'float32', (C_stride, 4))
+    C[:] = _as_float(alpha) * A.dot(B) + _as_float(beta) * C
+    return 2 * P * Q * R + 3 * P * R, 4 * (P * Q + Q * R + 2 * P * R)
+
+def _sgemm_rnn_naive(drv, prog, unif, thread):
+    params, n = drv.uniforms(unif, 2)
+    flops = nbytes = 0
+    for p in drv.view(params, (thread, n), 'uint32').tolist():
+        f, b = _sgemm(drv, *p[:11])
+        flops += f
+        nbytes += b
+    return dict(flops=flops, nbytes=nbytes)
+
+def _clock(drv, prog, unif, thread):
+    f, done = drv.uniforms(unif, 2)
+    drv.view(done, 1, 'uint32')[0] = 1
+    return dict(cycles=5 * int(f))
+
+def _write_N(drv, prog, unif, thread):
+    data, done = drv.uniforms(unif, 2)
+    drv.view(data, 16, 'uint32')[:] = prog.args[0]
+    drv.view(done, 1, 'uint32')[0] = 1
+    return {}
+
+def _tmu_load(drv, prog, unif, qpus):
+    # Lane e of each active QPU q sums `loop` floats starting at
+    # X + q * loop * 64 + e * stride0, stepping by stride1.
+    loop, X, stride1, stride0, Y, done = drv.uniforms(unif, 6).tolist()
+    for q in qpus:
+        src = drv.view(X + q * loop * 64, (16, loop), 'float32', (stride0, stride1))
+        drv.view(Y + q * 64, 16, 'float32')[:] = src.sum(axis=1)
+    drv.view(done, 1, 'uint32')[0] = 1
+    return dict(cycles=len(qpus) * loop * (timing.tmu_latency + prog.args[0]))
+
+def _tmu_load_1_slot_1_qpu(drv, prog, unif, thread):
+    return _tmu_load(drv, prog, unif, [0])
+
+def _tmu_load_2_slot_1_qpu(drv, prog, unif, thread):
+    return _tmu_load(drv, prog, unif, [q for q in range(thread) if q % 4 == 0])
+
+def _sgemm_gpu_code(drv, prog, n_threads, uniforms):
+    flops = nbytes = 0
+    for u in uniforms.tolist():
+        h, q, w, A, B, C, A_stride, B_stride, C_stride, alpha, beta = u[1:12]
+        f, b = _sgemm(drv, 16 * h, q, 64 * w, A, A_stride, B, B_stride, C, C_stride, alpha, beta)
+        flops += f
+        nbytes += b
+    return dict(flops=flops, nbytes=nbytes)
+
+# Rows the VC4 conditional-execution kernels write: row 0 is untouched
+# (cond='never'), then zs, zc, ns, nc, cs, cc after comparing
+# [1]*16 with [0]*8 + [1]*8, which select the upper or lower eight lanes.
+_COND_LANES = [None, 'hi', 'lo', 'lo', 'hi', 'lo', 'hi']
+_COND_OPS = {
+    'cond_add': lambda x: x + np.uint32(1),
+    'cond_mul': lambda x: x * np.float32(2.0),
+}
+
+def _boilerplate(drv, prog, n_threads, uniforms):
+    f, nout = prog.args
+    src, dst = uniforms[0, :2]
+    name = getattr(f, '__name__', '')
+    dtype = 'float32' if name == 'cond_mul' else 'uint32'
+    X = drv.view(src, 16, dtype)
+    Y = drv.view(dst, (nout, 16), dtype)
+    for row, lanes in zip(range(nout), _COND_LANES):
+        Y[row] = X
+        if lanes is not None and name in _COND_OPS:
+            sel = slice(8, 16) if lanes == 'hi' else slice(0, 8)
+            Y[row, sel] = _COND_OPS[name](X[sel])
+    return dict(nbytes=4 * 16 * (nout + 1), cycles=4 * nout)
+
+KERNELS = {
+    'qpu_summation': _summation,
+    'qpu_scopy': _scopy,
+    'qpu_memset': _memset,
+    'qpu_sgemm_rnn_naive': _sgemm_rnn_naive,
+    'qpu_clock': _clock,
+    'qpu_write_N': _write_N,
+    'qpu_tmu_load_1_slot_1_qpu': _tmu_load_1_slot_1_qpu,
+    'qpu_tmu_load_2_slot_1_qpu': _tmu_load_2_slot_1_qpu,
+    'sgemm_gpu_code': _sgemm_gpu_code,
+    'boilerplate': _boilerplate,
+}
+
+################################################################################
+# Assembler, kernel cache and performance counters
+
+def qpu(func):
+    # Kernels are only ever run by name, so they are left as they are.
+    return func
+
+def assemble(kernel, *args, **kwargs):
+    return SimProgram(kernel, args, kwargs)
+
+class SimKernelCache(KernelCache):
+    # Same keys as the on-disk cache, but programs only live in memory.
+
+    def __init__(self):
+        self.assemble_fn = assemble
+        self.version = 'sim'
+        self.memo = {}
+
+    def assemble(self, kernel, *args, **kwargs):
+        key = self.key(kernel, *args, **kwargs)
+        if key not in self.memo:
+            self.memo[key] = assemble(kernel, *args, **kwargs)
+        return self.memo[key]
+
+class RegisterMapping(object):
+
+    def __init__(self, drv=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, value, traceback):
+        return False
+
+class PerformanceCounter(object):
+    # Counts QPU clock cycles since the counter was set up, split evenly
+    # over the requested counters and wrapped to 32 bits like the hardware.
+
+    def __init__(self, regmap, counters):
+        self.counters = counters
+        self.start = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, value, traceback):
+        return False
+
+    def result(self):
+        cycles = (time.perf_counter() - self.start) * timing.clock_mhz * 1e6
+        return [int(cycles / len(self.counters)) % (1 << 32)] * len(self.counters)
+
+CORE_PCTR_CYCLE_COUNT = 0
+
+def pack_unpack(pack, unpack, *args):
+    if len(args) == 1 and isinstance(args[0], (list, tuple)):
+        return [struct.unpack(unpack, struct.pack(pack, v))[0] for v in args[0]]
+    return struct.unpack(unpack, struct.pack(pack, *args))[0]
+
+rpi_vcsm = SimpleNamespace(CACHE_NONE=0, CACHE_HOST=1, CACHE_VC=2, CACHE_BOTH=3)
+
+def backend(board):
+    from hal import Backend
+
+    if board == 'vc6':
+        return Backend('sim', Driver=V3DDriver, RegisterMapping=RegisterMapping,
+                       PerformanceCounter=PerformanceCounter,
+                       CORE_PCTR_CYCLE_COUNT=CORE_PCTR_CYCLE_COUNT,
+                       pack_unpack=pack_unpack, qpu=qpu, kernels=SimKernelCache())
+    if board == 'vc4':
+        return Backend('sim', Driver=VC4Driver, RegisterMapping=RegisterMapping,
+                       PerformanceCounter=PerformanceCounter, rpi_vcsm=rpi_vcsm,
+                       qpu=qpu, kernels=SimKernelCache())
+    raise ValueError(f'unknown board {board}')
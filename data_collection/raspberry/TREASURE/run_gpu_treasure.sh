@@ -1,16 +1,16 @@
 #!/bin/bash
 
-if [ -e /sys/class/net/eth0 ]; then
-	mac=$( cat /sys/class/net/eth0/address | tr : _ )
-elif [ -e /sys/class/net/enx* ]; then
-	mac=$( cat /sys/class/net/enx*/address | tr : _ )
-elif [ -e /sys/class/net/wlan0 ]; then
-	mac=$( cat /sys/class/net/wlan0/address | tr : _ )
-else
-	mac=$( cat /sys/class/net/wlx*/address | tr : _ )
-fi
-
-model=$( cat /proc/device-tree/model | sed 's/\x0//g' )
+# Read with bash builtins rather than cat/sed/tr: no fork and exec before
+# the collector starts.
+for iface in /sys/class/net/eth0 /sys/class/net/enx* /sys/class/net/wlan0 /sys/class/net/wlx*; do
+	if [ -e $iface/address ]; then
+		read -r mac < $iface/address
+		break
+	fi
+done
+mac=${mac//:/_}
+
+read -r -d '' model < /proc/device-tree/model
 loop1=39
 loop2=19
 core=3
@@ -22,36 +22,21 @@ random=100000000
 
 sudo sysctl kernel.randomize_va_space=0 #Disable random memory ASLR
 
+# One long-lived collector per boot: (loop1+1) bursts of (loop2+1) samples,
+# with a 2 s cool-down between bursts as the old nested loops did.
+samples=$(( (loop1 + 1) * (loop2 + 1) ))
+burst=$(( loop2 + 1 ))
+cooldown=2
+
 if [[ $model == *"Pi 4"* ]];
 then
 	#sudo export PYTHONPATH=sandbox/
-	for s in `seq 0 $loop1` #39
-	do
-		for i in `seq 0 $loop2`
-		do
-			sudo PYTHONHASHSEED=0 PYTHONPATH=sandbox/ chrt --rr 99 taskset -c $core python3 TREASURE_tests_VC6.py >> feat_gpu_$mac
-		done
-		sleep 2
-	done
+	sudo PYTHONHASHSEED=0 PYTHONPATH=sandbox/ chrt --rr 99 taskset -c $core python3 TREASURE_tests_VC6.py --samples $samples --burst $burst --cooldown $cooldown >> feat_gpu_$mac
 elif [[ $model == *"Pi 3"* ]];
 then
-	for s in `seq 0 $loop1` #39
-	do
-		for i in `seq 0 $loop2`
-		do
-			sudo PYTHONHASHSEED=0 chrt --rr 99 taskset -c $core python3 TREASURE_tests_VC4.py >> feat_gpu_$mac
-		done
-		sleep 2
-	done
+	sudo PYTHONHASHSEED=0 chrt --rr 99 taskset -c $core python3 TREASURE_tests_VC4.py --samples $samples --burst $burst --cooldown $cooldown >> feat_gpu_$mac
 else
-	for s in `seq 0 $loop1` #39
-	do
-		for i in `seq 0 $loop2`
-		do
-			sudo PYTHONHASHSEED=0 chrt --rr 10 python3 TREASURE_tests_VC4.py >> feat_gpu_$mac
-		done
-		sleep 2
-	done
+	sudo PYTHONHASHSEED=0 chrt --rr 10 python3 TREASURE_tests_VC4.py --samples $samples --burst $burst --cooldown $cooldown >> feat_gpu_$mac
 fi
 
 sudo reboot
@@ -0,0 +1,166 @@
+
+# Runs the features of one sample, overlapping the ones that don't interfere.
+# Every task declares an interference class and the resources it touches:
+#   EXCLUSIVE  noise-sensitive, runs with nothing else in flight
+#   WAIT       mostly sleeps (get_QPU_freq), runs in a thread of this process
+#   SHARED     CPU/storage work that tolerates a neighbour, runs in a child
+#              process pinned to one of the spare cores
+# Two tasks sharing a resource never overlap and keep their declared order.
+# TREASURE PROJECT 2021
+import multiprocessing
+import os
+import queue
+import threading
+
+import lazy_imports
+
+EXCLUSIVE = 'exclusive'
+WAIT = 'wait'
+SHARED = 'shared'
+
+class Task(object):
+
+    def __init__(self, fn, *args, kind=EXCLUSIVE, resources=(), columns=None,
+                 dtype='int64', imports=(), name=None, overhead=None, **kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.kind = kind
+        self.resources = frozenset(resources)
+        # Output columns filled from the task's result, in order.
+        self.columns = columns if columns is not None else [fn.__name__]
+        self.dtype = dtype
+        # Modules the task needs, imported by load() right before it runs.
+        self.imports = list(imports)
+        self.name = name or self.columns[0]
+        # Harness primitive (see calibration.py) included in each measurement.
+        self.overhead = overhead
+
+    def load(self):
+        for module in self.imports:
+            lazy_imports.load(module)
+
+    def __call__(self):
+        return self.fn(*self.args, **self.kwargs)
+
+    def conflicts(self, other):
+        return bool(self.resources & other.resources)
+
+    def compatible(self, other):
+        if EXCLUSIVE in (self.kind, other.kind):
+            return False
+        return not self.conflicts(other)
+
+def _child(task, core, conn):
+    try:
+        os.sched_setaffinity(0, {core})
+        conn.send((task(), None))
+    except BaseException as e:
+        conn.send((None, e))
+    finally:
+        conn.close()
+
+class Scheduler(object):
+
+    def __init__(self, cores=(), gate=None):
+        # cores: spare CPUs for SHARED tasks; without any, run() is serial.
+        self.cores = list(cores)
+        # gate: called before a task starts with nothing else in flight
+        # (thermal.Thermal.gate holds it until the SoC is in band).
+        self.gate = gate
+
+    def _call(self, task):
+        if self.gate is not None:
+            self.gate()
+        return task()
+
+    def run(self, tasks):
+        # Imports happen here, in this process, so that forked children
+        # inherit them instead of importing on every sample.
+        for task in tasks:
+            task.load()
+        if not self.cores:
+            return [self._call(task) for task in tasks]
+
+        results = [None] * len(tasks)
+        pending = list(range(len(tasks)))
+        running = {}
+        procs = {}
+        free = list(self.cores)
+        done = queue.Queue()
+
+        while pending or running:
+            i = self._next(tasks, pending, running, free)
+            if i is not None:
+                pending.remove(i)
+                task = tasks[i]
+                if task.kind == EXCLUSIVE or (task.kind == SHARED and not free):
+                    results[i] = self._call(task)
+                else:
+                    if not running and self.gate is not None:
+                        self.gate()
+                    core = free.pop(0) if task.kind == SHARED else None
+                    running[i] = core
+                    procs[i] = self._start(i, task, core, done)
+                continue
+
+            if running:
+                i, result, error = done.get()
+                core = running.pop(i)
+                procs.pop(i)
+                if error is not None:
+                    self._stop(running, procs, done)
+                    where = f'on core {core}' if core is not None else 'in a thread'
+                    raise RuntimeError(f'task {tasks[i].name} failed {where}: {error!r}') from error
+                results[i] = result
+                if core is not None:
+                    free.append(core)
+        return results
+
+    def _stop(self, running, procs, done):
+        # Nothing of a failed sample is left in flight: children are
+        # killed, WAIT threads (which can't be) run to the end.
+        for proc in procs.values():
+            if proc is not None:
+                proc.terminate()
+        while running:
+            running.pop(done.get()[0])
+
+    def _next(self, tasks, pending, running, free):
+        for pos, i in enumerate(pending):
+            task = tasks[i]
+            if any(task.conflicts(tasks[j]) for j in pending[:pos]):
+                continue
+            if task.kind == EXCLUSIVE or (task.kind == SHARED and not free):
+                if running:
+                    continue
+            elif not all(task.compatible(tasks[j]) for j in running):
+                continue
+            return i
+        return None
+
+    def _start(self, i, task, core, done):
+        if core is None:
+            def target():
+                try:
+                    done.put((i, task(), None))
+                except BaseException as e:
+                    done.put((i, None, e))
+            threading.Thread(target=target, daemon=True).start()
+            return None
+
+        recv, send = multiprocessing.Pipe(duplex=False)
+        proc = multiprocessing.get_context('fork').Process(
+            target=_child, args=(task, core, send), daemon=True)
+        proc.start()
+        send.close()
+
+        def reader():
+            try:
+                result, error = recv.recv()
+            except EOFError:
+                result, error = None, RuntimeError(f'task {task.name} died')
+            proc.join()
+            done.put((i, result, error))
+        threading.Thread(target=reader, daemon=True).start()
+        return proc
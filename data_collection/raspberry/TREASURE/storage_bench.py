@@ -0,0 +1,357 @@
+
+# Storage latency benchmarks with selectable back-ends:
+#   syscall  os.write/os.fsync and os.lseek/os.read per block (original tests)
+#   vector   os.pwritev/os.preadv on a preallocated buffer, no per-block
+#            allocation
+#   uring    io_uring submission and timing done in a small C helper
+# and page-cache handling modes:
+#   cached    plain buffered I/O (original tests)
+#   direct    O_DIRECT from page-aligned buffers, bypassing the page cache
+#   dontneed  buffered, but each block is evicted with posix_fadvise
+#             (outside the timing) so reads have to go to the device
+# Per-block latencies (ns) are stored in a preallocated numpy.int64 array.
+# mmap_read_test() samples page-fault latency through a file mapping instead;
+# its 'dontneed' mode evicts the file with posix_fadvise before mapping it,
+# so the faults are served by the device rather than the page cache.
+# queue_depth_sweep() keeps 1..8 requests in flight from a thread pool of
+# os.preadv/os.pwrite workers (both release the GIL) over a range of block
+# sizes and reports throughput and latency percentiles per cell.
+# TREASURE PROJECT 2021
+import mmap
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from ctypes import cdll, c_int, c_int64, c_void_p
+from random import shuffle
+
+import numpy as np
+
+BACKENDS = ('syscall', 'vector', 'uring')
+CACHE_MODES = ('cached', 'direct', 'dontneed')
+
+# O_DIRECT alignment of buffers, sizes and offsets (a page covers the
+# logical block size of SD cards and most other devices)
+ALIGN = mmap.PAGESIZE
+
+QD_BLOCK_SIZES = (4096, 16384, 65536, 262144, 1048576)
+QD_DEPTHS = (1, 2, 4, 8)
+QD_OPS = ('read', 'write')
+# MB/s over the cell and per-request latency percentiles in us
+QD_STATS = ('mbps', 'p50_us', 'p90_us', 'p99_us')
+
+# access pattern hint given to the mapping; 'dontneed' is about the page
+# cache (see mmap_read_test), not the pattern
+MADVISE = {
+    'normal': mmap.MADV_NORMAL,
+    'random': mmap.MADV_RANDOM,
+    'sequential': mmap.MADV_SEQUENTIAL,
+    'dontneed': mmap.MADV_NORMAL,
+}
+
+class UringHelper(object):
+
+    def __init__(self, path = './libstorage_helper.so'):
+
+        try:
+            self.lib = cdll.LoadLibrary(path)
+        except OSError:
+            # built next to the final path and renamed, so a failed build
+            # (e.g. no liburing) raises here instead of leaving a bad .so
+            tmp = f'{path}.{os.getpid()}'
+            subprocess.run(f'gcc -O2 -shared -fPIC -o {tmp} -xc - -luring'.split(), text=True,
+                           check=True, input='''
+#include <stdint.h>
+#include <time.h>
+#include <liburing.h>
+
+static int64_t now_ns(void) {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (int64_t)ts.tv_sec * 1000000000 + ts.tv_nsec;
+}
+
+/* One request in flight at a time, like the syscall tests. Returns the
+ * number of blocks done, or a negative errno. */
+int64_t uring_blocks(int fd, int write, char * buf, int64_t block_size,
+                     const int64_t * offsets, int64_t n, int64_t * took) {
+    struct io_uring ring;
+    struct io_uring_cqe * cqe;
+    int64_t i;
+    int k, r, wait;
+    int ret = io_uring_queue_init(4, &ring, 0);
+    if (ret < 0)
+        return ret;
+    for (i = 0; i < n; i++) {
+        int64_t start = now_ns();
+        struct io_uring_sqe * sqe = io_uring_get_sqe(&ring);
+        if (write) {
+            /* fsync linked after the write, as os.write + os.fsync */
+            io_uring_prep_write(sqe, fd, buf, block_size, offsets[i]);
+            sqe->flags |= IOSQE_IO_LINK;
+            io_uring_prep_fsync(io_uring_get_sqe(&ring), fd, 0);
+            wait = 2;
+        } else {
+            io_uring_prep_read(sqe, fd, buf, block_size, offsets[i]);
+            wait = 1;
+        }
+        io_uring_submit(&ring);
+        for (k = 0; k < wait; k++) {
+            r = io_uring_wait_cqe(&ring, &cqe);
+            if (r == 0) {
+                r = cqe->res;
+                io_uring_cqe_seen(&ring, cqe);
+            }
+            if (k == 0 || r < 0)
+                ret = r;
+        }
+        took[i] = now_ns() - start;
+        if (ret < 0 || (!write && ret == 0))
+            break;
+    }
+    io_uring_queue_exit(&ring);
+    return ret < 0 ? ret : i;
+}
+'''
+            )
+            os.replace(tmp, path)
+            self.lib = cdll.LoadLibrary(path)
+
+        self.lib.uring_blocks.restype = c_int64
+        self.lib.uring_blocks.argtypes = [
+            c_int, c_int, c_void_p, c_int64,
+            np.ctypeslib.ndpointer(dtype=np.int64, flags="C_CONTIGUOUS"),
+            c_int64,
+            np.ctypeslib.ndpointer(dtype=np.int64, flags="C_CONTIGUOUS"),
+        ]
+
+    def blocks(self, fd, write, buff, offsets, took):
+        buf = np.frombuffer(buff, dtype=np.uint8)
+        n = self.lib.uring_blocks(fd, int(write), buf.ctypes.data, len(buff),
+                                  offsets, len(offsets), took)
+        if n < 0:
+            raise OSError(-n, os.strerror(-n))
+        return n
+
+_uring = None
+
+def uring():
+    global _uring
+    if _uring is None:
+        _uring = UringHelper()
+    return _uring
+
+def _open(file, flags, cache):
+    if cache == 'direct':
+        flags |= os.O_DIRECT
+    elif cache not in CACHE_MODES:
+        raise ValueError(f'unknown cache mode {cache}')
+    return os.open(file, flags, 0o777)
+
+def _aligned(block_size):
+    # anonymous mappings are page aligned
+    if block_size % ALIGN:
+        raise ValueError(f'O_DIRECT needs blocks of a multiple of {ALIGN} bytes')
+    return mmap.mmap(-1, block_size)
+
+def _evict(f, offset, length):
+    os.posix_fadvise(f, offset, length, os.POSIX_FADV_DONTNEED)
+
+def _offsets(block_size, blocks_count, randomize):
+    offsets = list(range(0, blocks_count * block_size, block_size))
+    if randomize:
+        shuffle(offsets)
+    return np.array(offsets, dtype=np.int64)
+
+def write_test(file, block_size, blocks_count, backend='syscall', cache='cached'):
+    f = _open(file, os.O_CREAT | os.O_WRONLY, cache)  # low-level I/O
+    took = np.zeros(blocks_count, dtype=np.int64)
+    aligned = _aligned(block_size) if cache == 'direct' else None
+    evict = cache == 'dontneed'
+
+    try:
+        if backend == 'syscall':
+            for i in range(blocks_count):
+                buff = os.urandom(block_size)
+                if aligned is not None:
+                    aligned[:] = buff
+                    buff = aligned
+                start = time.perf_counter_ns()
+                os.write(f, buff)
+                os.fsync(f)  # force write to disk
+                took[i] = time.perf_counter_ns() - start
+                if evict:
+                    _evict(f, i * block_size, block_size)
+        elif backend == 'vector':
+            buff = aligned if aligned is not None else bytearray(block_size)
+            buff[:] = os.urandom(block_size)
+            buff = [memoryview(buff)]
+            for i in range(blocks_count):
+                start = time.perf_counter_ns()
+                os.pwritev(f, buff, i * block_size)
+                os.fsync(f)
+                took[i] = time.perf_counter_ns() - start
+                if evict:
+                    _evict(f, i * block_size, block_size)
+        elif backend == 'uring':
+            buff = aligned if aligned is not None else bytearray(block_size)
+            buff[:] = os.urandom(block_size)
+            uring().blocks(f, True, buff, _offsets(block_size, blocks_count, False), took)
+            if evict:
+                _evict(f, 0, 0)
+        else:
+            raise ValueError(f'unknown storage backend {backend}')
+    finally:
+        os.close(f)
+    return took
+
+def read_test(file, block_size, blocks_count, backend='syscall', cache='cached'):
+    f = _open(file, os.O_RDONLY, cache)  # low-level I/O
+    # generate random read positions
+    offsets = _offsets(block_size, blocks_count, True)
+    took = np.zeros(blocks_count, dtype=np.int64)
+    n = blocks_count
+    aligned = _aligned(block_size) if cache == 'direct' else None
+    evict = cache == 'dontneed'
+
+    try:
+        if backend == 'syscall':
+            for i, offset in enumerate(offsets.tolist()):
+                if evict:
+                    _evict(f, offset, block_size)
+                start = time.perf_counter_ns()
+                os.lseek(f, offset, os.SEEK_SET)  # set position
+                if aligned is None:
+                    buff = os.read(f, block_size)  # read from position
+                else:
+                    buff = os.readv(f, [aligned])
+                took[i] = time.perf_counter_ns() - start
+                if not buff:  # if EOF reached
+                    n = i
+                    break
+        elif backend == 'vector':
+            buff = [memoryview(aligned if aligned is not None else bytearray(block_size))]
+            for i, offset in enumerate(offsets.tolist()):
+                if evict:
+                    _evict(f, offset, block_size)
+                start = time.perf_counter_ns()
+                got = os.preadv(f, buff, offset)
+                took[i] = time.perf_counter_ns() - start
+                if not got:
+                    n = i
+                    break
+        elif backend == 'uring':
+            # one call for all blocks: evict the whole file up front
+            buff = aligned if aligned is not None else bytearray(block_size)
+            if evict:
+                _evict(f, 0, 0)
+            n = uring().blocks(f, False, buff, offsets, took)
+        else:
+            raise ValueError(f'unknown storage backend {backend}')
+    finally:
+        os.close(f)
+    return took[:n]
+
+def mmap_read_test(file, block_size, blocks_count, advice='normal'):
+    # Touch every page of the mapping, block by block in shuffled order, and
+    # time each first access. A fresh mapping faults on every page anyway,
+    # but those are minor faults while the file is in the page cache (as it
+    # is right after write_test); 'dontneed' evicts the file first so every
+    # fault reads from the device.
+    f = os.open(file, os.O_RDONLY)
+    try:
+        size = min(os.fstat(f).st_size, blocks_count * block_size)
+        if advice == 'dontneed':
+            _evict(f, 0, 0)
+        mm = mmap.mmap(f, size, prot=mmap.PROT_READ)
+    finally:
+        os.close(f)
+
+    page = mmap.PAGESIZE
+    took = np.zeros((size + page - 1) // page, dtype=np.int64)
+    try:
+        mm.madvise(MADVISE[advice])
+        n = 0
+        for offset in _offsets(block_size, (size + block_size - 1) // block_size, True).tolist():
+            for p in range(offset, min(offset + block_size, size), page):
+                start = time.perf_counter_ns()
+                mm[p]
+                took[n] = time.perf_counter_ns() - start
+                n += 1
+    finally:
+        mm.close()
+    return took[:n]
+
+def _qd_cell(pool, f, write, buffers, block_size, depth, offsets):
+    # Worker k issues requests k, k + depth, ... back to back, so `depth`
+    # of them are outstanding until the last round.
+    took = np.zeros(len(offsets), dtype=np.int64)
+
+    def worker(k):
+        buff = buffers[k][:block_size]
+        for i in range(k, len(offsets), depth):
+            offset = int(offsets[i])
+            start = time.perf_counter_ns()
+            if write:
+                os.pwrite(f, buff, offset)
+            else:
+                os.preadv(f, [buff], offset)
+            took[i] = time.perf_counter_ns() - start
+
+    start = time.perf_counter_ns()
+    for future in [pool.submit(worker, k) for k in range(depth)]:
+        future.result()
+    if write:
+        os.fsync(f)
+    elapsed = time.perf_counter_ns() - start
+    return [len(offsets) * block_size / elapsed * 1e3,
+            *(np.percentile(took, (50, 90, 99)) * 1e-3)]
+
+def queue_depth_sweep(file, block_sizes=QD_BLOCK_SIZES, depths=QD_DEPTHS, ops=QD_OPS,
+                      requests=32, cache='cached'):
+    # Returns an array of shape (ops, block sizes, depths, QD_STATS). Each
+    # cell does `requests` block-aligned random accesses to a file that is
+    # filled once (and kept across samples) to fit the biggest cell.
+    # Unless the file is opened O_DIRECT it is evicted before every cell,
+    # 'cached' included: the kept file would otherwise be served from the
+    # page cache, and the sweep is about the device. For the same reason
+    # writes are O_DSYNC, so each one is timed to the device and not to
+    # the page cache.
+    size = max(block_sizes) * requests
+    if not os.path.exists(file) or os.path.getsize(file) != size:
+        with open(file, 'wb') as out:
+            for _ in range(0, size, max(block_sizes)):
+                out.write(os.urandom(max(block_sizes)))
+            os.fsync(out.fileno())
+
+    result = np.zeros((len(ops), len(block_sizes), len(depths), len(QD_STATS)))
+    # page aligned, so O_DIRECT works too
+    buffers = [memoryview(_aligned(max(block_sizes))) for _ in range(max(depths))]
+    for b in buffers:
+        b[:] = os.urandom(len(b))
+    f = _open(file, os.O_RDWR | os.O_DSYNC, cache)
+    try:
+        with ThreadPoolExecutor(max_workers=max(depths)) as pool:
+            for i, op in enumerate(ops):
+                for j, block_size in enumerate(block_sizes):
+                    for k, depth in enumerate(depths):
+                        offsets = _offsets(block_size, size // block_size, True)[:requests]
+                        if cache != 'direct':
+                            _evict(f, 0, 0)
+                        result[i, j, k] = _qd_cell(pool, f, op == 'write', buffers,
+                                                   block_size, depth, offsets)
+    finally:
+        os.close(f)
+    return result
+
+def queue_depth_columns(block_sizes=QD_BLOCK_SIZES, depths=QD_DEPTHS, ops=QD_OPS,
+                        cache='cached'):
+    # names for queue_depth_sweep(...).ravel(), with the cache mode as in
+    # the read/write test columns
+    mode = '' if cache == 'cached' else f'{cache}_'
+    return [f'storage_qd_{mode}{op}_{block_size // 1024}k_qd{depth}_{stat}'
+            for op in ops for block_size in block_sizes for depth in depths
+            for stat in QD_STATS]
+
+def queue_depth_features(file, requests=32, cache='cached'):
+    return queue_depth_sweep(file, requests=requests, cache=cache).ravel()
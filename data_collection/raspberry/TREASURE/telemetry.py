@@ -0,0 +1,164 @@
+
+# Board telemetry read in-process, without spawning vcgencmd/cat/sed.
+#   temperature  /sys/class/thermal, else the VideoCore mailbox
+#   clocks/volts the mailbox property interface on /dev/vcio
+#   model        /proc/device-tree/model
+#   MAC address  /sys/class/net/<interface>/address
+# Anything that can't be read (not a Pi, no access to /dev/vcio) comes from
+# FIXTURE instead, or from the JSON file named by TREASURE_TELEMETRY, and
+# its name is added to `fallbacks`.
+# TREASURE PROJECT 2021
+import array
+import fcntl
+import json
+import os
+import struct
+
+THERMAL_ZONE = '/sys/class/thermal/thermal_zone0/temp'
+MODEL = '/proc/device-tree/model'
+NET = '/sys/class/net'
+MBOX_DEVICE = '/dev/vcio'
+
+# _IOWR(100, 0, char *)
+IOCTL_MBOX_PROPERTY = (3 << 30) | (struct.calcsize('P') << 16) | (100 << 8)
+MBOX_SUCCESS = 0x80000000
+
+TAG_GET_VOLTAGE = 0x00030003
+TAG_GET_TEMPERATURE = 0x00030006
+TAG_GET_THROTTLED = 0x00030046
+TAG_GET_MEASURED_CLOCK_RATE = 0x00030047
+
+CLOCKS = {'emmc': 1, 'uart': 2, 'arm': 3, 'core': 4, 'v3d': 5, 'h264': 6,
+          'isp': 7, 'sdram': 8, 'pixel': 9, 'pwm': 10}
+VOLTAGES = {'core': 1, 'sdram_c': 2, 'sdram_p': 3, 'sdram_i': 4}
+
+# Values for hosts without the hardware: an idle Pi 4, with the same
+# placeholders the scripts used before for the model and MAC.
+FIXTURE = {
+    'model': 'unknown',
+    'mac': '00:00:00:00:00:00',
+    'temperature': 45.0,
+    'throttled': 0,
+    'clock_arm': 600.0, 'clock_core': 200.0, 'clock_v3d': 250.0,
+    'clock_emmc': 100.0, 'clock_uart': 48.0, 'clock_h264': 0.0, 'clock_isp': 0.0,
+    'clock_sdram': 3200.0, 'clock_pixel': 0.0, 'clock_pwm': 0.0,
+    'volts_core': 0.85, 'volts_sdram_c': 1.1, 'volts_sdram_p': 1.1, 'volts_sdram_i': 1.1,
+}
+if os.environ.get('TREASURE_TELEMETRY'):
+    with open(os.environ['TREASURE_TELEMETRY']) as f:
+        FIXTURE.update(json.load(f))
+
+fallbacks = set()
+
+def _fixture(name):
+    fallbacks.add(name)
+    return FIXTURE[name]
+
+class Mailbox(object):
+
+    def __init__(self, device=MBOX_DEVICE):
+        self.fd = os.open(device, os.O_RDWR)
+
+    def property(self, tag, *values, words=2):
+        # One tag per message; returns the response's value words.
+        n = max(len(values), words)
+        buf = array.array('I', [0] * (6 + n))
+        buf[0] = len(buf) * 4
+        buf[2] = tag
+        buf[3] = n * 4
+        buf[5:5 + len(values)] = array.array('I', values)
+        fcntl.ioctl(self.fd, IOCTL_MBOX_PROPERTY, buf, True)
+        if buf[1] != MBOX_SUCCESS:
+            raise OSError(f'mailbox tag {tag:#x} failed: {buf[1]:#x}')
+        return buf[5:5 + n].tolist()
+
+    def close(self):
+        os.close(self.fd)
+
+# opened on first use; False once opening it failed
+_mailbox = None
+
+def _property(tag, *values):
+    global _mailbox
+    if _mailbox is None:
+        try:
+            _mailbox = Mailbox()
+        except OSError:
+            _mailbox = False
+    if not _mailbox:
+        raise OSError(f'{MBOX_DEVICE} not available')
+    return _mailbox.property(tag, *values)
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+def temperature():
+    # degrees C
+    try:
+        return int(_read(THERMAL_ZONE)) / 1000
+    except (OSError, ValueError):
+        pass
+    try:
+        return _property(TAG_GET_TEMPERATURE, 0)[1] / 1000
+    except OSError:
+        return _fixture('temperature')
+
+def clock(name):
+    # measured rate in MHz of one of CLOCKS
+    try:
+        return _property(TAG_GET_MEASURED_CLOCK_RATE, CLOCKS[name])[1] * 1e-6
+    except OSError:
+        return _fixture(f'clock_{name}')
+
+def voltage(name):
+    # volts on one of VOLTAGES
+    try:
+        return _property(TAG_GET_VOLTAGE, VOLTAGES[name])[1] * 1e-6
+    except OSError:
+        return _fixture(f'volts_{name}')
+
+def throttled():
+    # under-voltage/throttling bits, as in "vcgencmd get_throttled"
+    try:
+        return _property(TAG_GET_THROTTLED, 0)[0]
+    except OSError:
+        return _fixture('throttled')
+
+def model():
+    try:
+        return _read(MODEL).strip('\x00\n')
+    except OSError:
+        return _fixture('model')
+
+def interfaces():
+    # network interfaces but lo, in ifindex order like socket.if_nameindex()
+    try:
+        names = [n for n in os.listdir(NET) if n != 'lo']
+        return sorted(names, key=lambda n: int(_read(os.path.join(NET, n, 'ifindex'))))
+    except (OSError, ValueError):
+        return []
+
+def mac_address(interface=None):
+    # interface: None for the first one
+    if interface is None:
+        found = interfaces()
+        if not found:
+            return _fixture('mac')
+        interface = found[0]
+    try:
+        return _read(os.path.join(NET, interface, 'address')).strip()
+    except OSError:
+        return _fixture('mac')
+
+if __name__ == '__main__':
+    print('model', model())
+    print('mac', mac_address())
+    print('temperature', temperature())
+    print('throttled', hex(throttled()))
+    for name in CLOCKS:
+        print(f'clock_{name}', clock(name))
+    for name in VOLTAGES:
+        print(f'volts_{name}', voltage(name))
+    if fallbacks:
+        print('from fixtures:', ' '.join(sorted(fallbacks)))
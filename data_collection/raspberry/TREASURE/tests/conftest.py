@@ -0,0 +1,10 @@
+
+# The tests run the scripts on the NumPy simulator, without timing delays,
+# so they work on any x86 host.
+# TREASURE PROJECT 2021
+import os
+import sys
+
+os.environ.setdefault('TREASURE_BACKEND', 'sim')
+os.environ.setdefault('TREASURE_SIM_TIMING', 'scale=0')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,104 @@
+
+# Orchestration and storage paths, run on the simulator back-end.
+# TREASURE PROJECT 2021
+import importlib
+import os
+import shutil
+import time
+
+import numpy as np
+import pytest
+
+import counters
+from feature_store import FeatureStore, load
+from scheduler import Scheduler, Task, EXCLUSIVE, WAIT, SHARED
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.mark.parametrize('script', ['TREASURE_tests_VC6', 'TREASURE_tests_VC4'])
+def test_sample_lite(script, tmp_path, monkeypatch):
+    # test files, fixtures and helper libraries are created in the cwd;
+    # csv_read expects the dataset next to them, as run_gpu_treasure.sh does
+    shutil.copy(os.path.join(HERE, 'test_dataset.csv'), tmp_path)
+    monkeypatch.chdir(tmp_path)
+    module = importlib.import_module(script)
+    monkeypatch.setattr(module, 'selection', dict(preset='lite'))
+    with module.session:
+        record = module.sample()
+    columns = [c for c, _ in module.schema()]
+    assert list(record) == ['timestamp'] + columns + ['label']
+    assert all(record[c] is not None for c in columns)
+
+def test_checkpoint_values_wrap():
+    # two counters at 5e9 and 1e9 counts/s: the first wraps every second
+    durations = [1, 2]
+    times = counters.schedule(durations)
+    counts = np.stack([times * 5e9, times * 1e9], axis=1).astype(np.int64)
+    expected = [(5e9 * d % counters.WRAP + 1e9 * d % counters.WRAP) * 1e-6 for d in durations]
+    assert counters.checkpoint_values(times, counts, durations) == pytest.approx(expected)
+
+def _window(seconds, value):
+    start = time.monotonic()
+    time.sleep(seconds)
+    return [value, start, time.monotonic()]
+
+def _fail():
+    raise OSError('device gone')
+
+def _tasks():
+    return [
+        Task(_window, 0.3, 'wait', kind=WAIT, resources=['pctr'], name='wait'),
+        Task(_window, 0.1, 'shared', kind=SHARED, resources=['storage'], name='shared'),
+        Task(_window, 0.05, 'exclusive', kind=EXCLUSIVE, resources=['gpu'], name='exclusive'),
+    ]
+
+def _overlap(a, b):
+    return a[1] < b[2] and b[1] < a[2]
+
+def test_scheduler_serial_and_parallel():
+    serial = Scheduler().run(_tasks())
+    assert [r[0] for r in serial] == ['wait', 'shared', 'exclusive']
+    assert not any(_overlap(a, b) for a, b in zip(serial, serial[1:]))
+
+    core = min(os.sched_getaffinity(0))
+    wait, shared, exclusive = Scheduler([core]).run(_tasks())
+    assert [wait[0], shared[0], exclusive[0]] == ['wait', 'shared', 'exclusive']
+    assert _overlap(wait, shared)
+    assert not _overlap(exclusive, wait) and not _overlap(exclusive, shared)
+
+def test_scheduler_failure_names_task():
+    core = min(os.sched_getaffinity(0))
+    tasks = [Task(_window, 0.2, 'wait', kind=WAIT, name='wait'),
+             Task(_fail, kind=SHARED, resources=['storage'], name='write_test')]
+    with pytest.raises(RuntimeError, match=f'write_test failed on core {core}'):
+        Scheduler([core]).run(tasks)
+
+SCHEMA = [('temperature', 'float32'), ('cpu_hash', 'int64'), ('gpu_sum', 'int64')]
+
+@pytest.mark.parametrize('format', ['npz', 'parquet'])
+def test_feature_store_round_trip(format, tmp_path):
+    if format == 'parquet':
+        pytest.importorskip('pyarrow')
+    rows = [dict(timestamp=float(i), temperature=45.0 + i, cpu_hash=i, gpu_sum=10 * i)
+            for i in range(3)]
+    del rows[2]['gpu_sum']
+    with FeatureStore(str(tmp_path), SCHEMA, 'aa:bb', 'vc6', chunk_rows=2, format=format) as store:
+        for row in rows:
+            store.append(row)
+    assert len([f for f in os.listdir(tmp_path) if f.startswith('part-')]) == 2
+
+    df = load(str(tmp_path))
+    assert list(df.columns) == ['timestamp', 'device_id', 'board', 'temperature',
+                                'cpu_hash', 'gpu_sum']
+    assert df['cpu_hash'].tolist() == [0, 1, 2]
+    # missing integers are stored as -1
+    assert df['gpu_sum'].tolist() == [0, 10, -1]
+    assert (df['device_id'] == 'aa:bb').all()
+    assert load(str(tmp_path), columns=['gpu_sum'])['gpu_sum'].tolist() == [0, 10, -1]
+
+def test_feature_store_schema_mismatch(tmp_path):
+    FeatureStore(str(tmp_path), SCHEMA, 'aa:bb', 'vc6').close()
+    # reopening with the same schema appends
+    FeatureStore(str(tmp_path), SCHEMA, 'aa:bb', 'vc6').close()
+    with pytest.raises(ValueError, match='different schema'):
+        FeatureStore(str(tmp_path), SCHEMA[:2], 'aa:bb', 'vc6')
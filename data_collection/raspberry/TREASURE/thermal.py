@@ -0,0 +1,77 @@
+
+# SoC temperature and clocks around the benchmarks.
+# The scheduler calls gate() before starting each task: with a temperature
+# band set it holds the start until the SoC is inside the band (sleeping
+# when too hot, spinning when too cold, up to a timeout), and with tracing
+# on it reads the temperature and ARM/QPU clocks. features() summarises
+# the readings of one sample into the COLUMNS.
+# TREASURE PROJECT 2021
+import time
+
+import telemetry
+
+COLUMNS = [
+    'thermal_temp_start', 'thermal_temp_end', 'thermal_temp_min', 'thermal_temp_max',
+    'thermal_arm_mhz_min', 'thermal_arm_mhz_mean',
+    'thermal_qpu_mhz_min', 'thermal_qpu_mhz_mean',
+    'thermal_held_s',
+]
+
+def _warm(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+class Thermal(object):
+
+    def __init__(self, band=None, timeout=60.0, poll=0.5, trace=False):
+        # band: (low, high) in degrees C, or None to start tasks right away
+        self.band = band
+        self.timeout = timeout
+        self.poll = poll
+        self.trace = trace
+        self.reset()
+
+    @property
+    def active(self):
+        return self.band is not None or self.trace
+
+    def reset(self):
+        self.readings = []
+        self.held = 0.0
+
+    def hold(self):
+        # Seconds spent waiting for the band; gives up after the timeout
+        # or when there is no real temperature to wait on.
+        low, high = self.band
+        start = time.perf_counter()
+        while time.perf_counter() - start < self.timeout:
+            t = telemetry.temperature()
+            if 'temperature' in telemetry.fallbacks or low <= t <= high:
+                break
+            if t > high:
+                time.sleep(self.poll)
+            else:
+                _warm(self.poll)
+        return time.perf_counter() - start
+
+    def read(self):
+        self.readings.append((telemetry.temperature(), telemetry.clock('arm'),
+                              telemetry.clock('v3d')))
+
+    def gate(self):
+        if self.band is not None:
+            self.held += self.hold()
+        if self.trace:
+            self.read()
+
+    def features(self):
+        # Call after the sample's tasks; adds the closing reading.
+        self.read()
+        temp, arm, qpu = zip(*self.readings)
+        return dict(zip(COLUMNS, [
+            temp[0], temp[-1], min(temp), max(temp),
+            min(arm), sum(arm) / len(arm),
+            min(qpu), sum(qpu) / len(qpu),
+            self.held,
+        ]))
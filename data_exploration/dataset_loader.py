@@ -0,0 +1,171 @@
+
+# Incremental loader for the feat_gpu_* files in dataset_labels/.
+# Devices only ever append rows, so each file is parsed once: a manifest
+# keeps the byte offset and row count reached in every file, new rows are
+# parsed from that offset on, and the parsed rows are kept as downcast
+# Parquet chunks (pickle when pyarrow is missing) in a cache directory.
+# TREASURE PROJECT 2021
+import hashlib
+import importlib.util
+import io
+import json
+import os
+
+import pandas as pd
+
+FORMAT = 'parquet' if importlib.util.find_spec('pyarrow') else 'pickle'
+
+# Tails are merged into one chunk once a file has this many
+MAX_PARTS = 16
+
+def _fingerprint(path, size):
+    # Hash of the start of the file, to notice a file that was replaced
+    # rather than appended to.
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read(min(size, 4096))).hexdigest()
+
+def _is_header(line):
+    first = line.split(b',', 1)[0].strip()
+    try:
+        float(first)
+        return False
+    except ValueError:
+        return True
+
+def downcast(df):
+    # Smallest float/int dtype that holds each numeric column; the
+    # features are timings and counter values, so float32 is plenty.
+    for name in df.columns:
+        kind = df[name].dtype.kind
+        if kind == 'f':
+            df[name] = pd.to_numeric(df[name], downcast='float')
+        elif kind in 'iu':
+            df[name] = pd.to_numeric(df[name], downcast='integer')
+    return df
+
+class DatasetCache(object):
+
+    def __init__(self, dataset_dir, cache_dir=None, prefix='feat_gpu_', names=None):
+        # names: column names for files without a header row
+        self.dataset_dir = dataset_dir
+        self.cache_dir = cache_dir or os.path.join(dataset_dir.rstrip('/') + '_cache')
+        self.prefix = prefix
+        self.names = names
+        self.manifest_file = os.path.join(self.cache_dir, 'manifest.json')
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.manifest = {}
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                self.manifest = json.load(f)
+
+    def files(self):
+        return sorted(f for f in os.listdir(self.dataset_dir) if f.startswith(self.prefix))
+
+    def _save_manifest(self):
+        tmp = self.manifest_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(tmp, self.manifest_file)
+
+    def _part_path(self, name, n):
+        ext = '.parquet' if FORMAT == 'parquet' else '.pkl'
+        return os.path.join(self.cache_dir, f'{name}.{n:05d}{ext}')
+
+    def _write_part(self, df, path):
+        if FORMAT == 'parquet':
+            df.to_parquet(path, index=False)
+        else:
+            df.to_pickle(path)
+
+    def _read_part(self, path):
+        if path.endswith('.parquet'):
+            return pd.read_parquet(path)
+        return pd.read_pickle(path)
+
+    def _reset(self, name):
+        for part in self.manifest.get(name, {}).get('parts', []):
+            try:
+                os.remove(os.path.join(self.cache_dir, part))
+            except FileNotFoundError:
+                pass
+        self.manifest[name] = {'offset': 0, 'rows': 0, 'fingerprint': None,
+                               'columns': None, 'parts': [], 'next': 0}
+
+    def update(self, name):
+        # Parse what was appended to one file since the last update. Returns
+        # the number of new rows.
+        path = os.path.join(self.dataset_dir, name)
+        size = os.path.getsize(path)
+        entry = self.manifest.get(name)
+        if entry is None or size < entry['offset'] or \
+                _fingerprint(path, entry['offset']) != entry['fingerprint']:
+            self._reset(name)
+            entry = self.manifest[name]
+        if size == entry['offset']:
+            return 0
+
+        with open(path, 'rb') as f:
+            f.seek(entry['offset'])
+            data = f.read(size - entry['offset'])
+        # A collector may be writing the last line right now: stop at the
+        # last complete one and pick the rest up next time.
+        end = data.rfind(b'\n') + 1
+        if end == 0:
+            return 0
+        data = data[:end]
+
+        if entry['columns'] is None:
+            first = data[:data.find(b'\n')]
+            if _is_header(first):
+                entry['columns'] = first.decode().strip().split(',')
+                data = data[len(first) + 1:]
+            else:
+                width = first.count(b',') + 1
+                entry['columns'] = list(self.names or [str(i) for i in range(width)])
+
+        rows = 0
+        if data:
+            df = pd.read_csv(io.BytesIO(data), header=None, names=entry['columns'],
+                             index_col=False)
+            rows = len(df)
+            part = self._part_path(name, entry['next'])
+            self._write_part(downcast(df), part)
+            entry['parts'].append(os.path.basename(part))
+            entry['next'] += 1
+
+        entry['offset'] += end
+        entry['rows'] += rows
+        entry['fingerprint'] = _fingerprint(path, entry['offset'])
+        if len(entry['parts']) > MAX_PARTS:
+            self._compact(name)
+        self._save_manifest()
+        return rows
+
+    def _compact(self, name):
+        entry = self.manifest[name]
+        df = self.frame(name)
+        old = entry['parts']
+        part = self._part_path(name, entry['next'])
+        self._write_part(df, part)
+        entry['parts'] = [os.path.basename(part)]
+        entry['next'] += 1
+        for p in old:
+            os.remove(os.path.join(self.cache_dir, p))
+
+    def frame(self, name):
+        entry = self.manifest[name]
+        parts = [self._read_part(os.path.join(self.cache_dir, p)) for p in entry['parts']]
+        if not parts:
+            return pd.DataFrame(columns=entry['columns'])
+        return downcast(pd.concat(parts, ignore_index=True))
+
+    def load(self):
+        # {file name: DataFrame}, like reading every file with pd.read_csv
+        frames = {}
+        for name in self.files():
+            self.update(name)
+            frames[name] = self.frame(name)
+        return frames
+
+def load_dataset(dataset_dir, cache_dir=None, names=None):
+    return DatasetCache(dataset_dir, cache_dir, names=names).load()
@@ -0,0 +1,216 @@
+
+# Online device identification with the notebook's RandomForest model.
+# Fingerprint rows (the collector's CSV lines: timestamp, temperature,
+# features..., label) arrive over a local TCP socket or by tailing dataset
+# files; they are queued, scaled and classified in batches with one
+# predict_proba call, and each row gets back the predicted device and its
+# probability. Latency and throughput counters are kept for monitoring.
+#
+#   python3 identification_service.py --model rf_identification.joblib --listen 127.0.0.1:5555
+#   python3 identification_service.py --model rf_identification.joblib --tail dataset_labels/feat_gpu_*
+# TREASURE PROJECT 2021
+import argparse
+import collections
+import os
+import queue
+import socketserver
+import sys
+import threading
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+
+def save_model(path, model, scaler, columns):
+    # columns: the feature columns the scaler was fitted on (df_X.columns)
+    joblib.dump({'model': model, 'scaler': scaler, 'columns': list(columns)}, path)
+
+def parse_row(line):
+    # Same columns as df_X in the notebook: everything but the timestamp
+    # and the label. Returns (features, label).
+    values = line.strip().split(',')
+    return [float(v) for v in values[1:-1]], values[-1]
+
+class _Request(object):
+
+    __slots__ = ('features', 'start', 'done', 'result')
+
+    def __init__(self, features):
+        self.features = features
+        self.start = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+
+class IdentificationService(object):
+
+    def __init__(self, model_path, max_batch=64, max_wait=0.005, n_jobs=1):
+        # max_wait: how long the first row of a batch waits for company
+        bundle = joblib.load(model_path)
+        self.model = bundle['model']
+        self.scaler = bundle['scaler']
+        self.columns = bundle['columns']
+        # parallel trees only pay off for big batches
+        if hasattr(self.model, 'n_jobs'):
+            self.model.n_jobs = n_jobs
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=10000)
+        self.requests = 0
+        self.batches = 0
+        self.errors = 0
+        self.started = time.perf_counter()
+        threading.Thread(target=self._worker, daemon=True).start()
+
+    def predict(self, rows):
+        # Vectorised identification of a list of feature rows, no queueing.
+        X = pd.DataFrame(np.asarray(rows, dtype=np.float64), columns=self.columns)
+        proba = self.model.predict_proba(self.scaler.transform(X))
+        best = proba.argmax(axis=1)
+        return [(self.model.classes_[i], float(p[i])) for i, p in zip(best, proba)]
+
+    def identify(self, features):
+        # Blocking, batched with whatever other rows are in flight.
+        if len(features) != len(self.columns) or not np.all(np.isfinite(features)):
+            with self.lock:
+                self.errors += 1
+            raise ValueError(f'expected {len(self.columns)} finite features, got {len(features)}')
+        request = _Request(features)
+        self.queue.put(request)
+        request.done.wait()
+        if isinstance(request.result, Exception):
+            raise request.result
+        return request.result
+
+    def _worker(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                results = self.predict([r.features for r in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            end = time.perf_counter()
+            with self.lock:
+                self.batches += 1
+                self.requests += len(batch)
+                self.latencies.extend(end - r.start for r in batch)
+            for request, result in zip(batch, results):
+                request.result = result
+                request.done.set()
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies, dtype=np.float64) * 1e3
+            elapsed = time.perf_counter() - self.started
+            stats = {
+                'requests': self.requests,
+                'errors': self.errors,
+                'batches': self.batches,
+                'mean_batch': self.requests / self.batches if self.batches else 0.0,
+                'throughput': self.requests / elapsed,
+            }
+        for q in (50, 90, 99):
+            stats[f'latency_p{q}_ms'] = float(np.percentile(latencies, q)) if latencies.size else 0.0
+        return stats
+
+def _answer(service, line):
+    try:
+        features, label = parse_row(line)
+        device, confidence = service.identify(features)
+    except ValueError as e:
+        return f'error,{e}'
+    except Exception as e:
+        # a model failure re-raised from the worker: reply instead of
+        # dropping the connection (or the --tail thread)
+        with service.lock:
+            service.errors += 1
+        return f'error,{e}'
+    return f'{device},{confidence:.4f},{label}'
+
+class _Handler(socketserver.StreamRequestHandler):
+    # One CSV row per line in, "device,confidence,claimed label" per line out.
+
+    def handle(self):
+        for line in self.rfile:
+            line = line.decode().strip()
+            if line:
+                self.wfile.write((_answer(self.server.service, line) + '\n').encode())
+
+class _Server(socketserver.ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+def serve(service, host, port):
+    server = _Server((host, port), _Handler)
+    server.service = service
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def follow(path, from_start=False, interval=0.5):
+    # Lines appended to a file, like tail -f; a partial last line is held
+    # back until the collector finishes writing it.
+    with open(path) as f:
+        if not from_start:
+            f.seek(0, os.SEEK_END)
+        pending = ''
+        while True:
+            chunk = f.readline()
+            if not chunk:
+                time.sleep(interval)
+                continue
+            pending += chunk
+            if pending.endswith('\n'):
+                yield pending
+                pending = ''
+
+def tail(service, paths, from_start=False, out=sys.stdout):
+    def run(path):
+        for line in follow(path, from_start):
+            print(f'{os.path.basename(path)},{_answer(service, line)}', file=out, flush=True)
+    for path in paths:
+        threading.Thread(target=run, args=(path,), daemon=True).start()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', required=True, help='file written by save_model()')
+    parser.add_argument('--listen', metavar='HOST:PORT', help='accept CSV rows on a TCP socket')
+    parser.add_argument('--tail', nargs='+', metavar='FILE', default=[],
+                        help='identify the rows appended to these files')
+    parser.add_argument('--from-start', action='store_true',
+                        help='with --tail, also identify the rows already in the files')
+    parser.add_argument('--max-batch', type=int, default=64)
+    parser.add_argument('--max-wait', type=float, default=0.005, help='seconds')
+    parser.add_argument('--stats-every', type=float, default=60.0, metavar='SECONDS',
+                        help='print the counters on stderr this often')
+    args = parser.parse_args(argv)
+    if not args.listen and not args.tail:
+        parser.error('nothing to do: give --listen and/or --tail')
+
+    service = IdentificationService(args.model, args.max_batch, args.max_wait)
+    if args.listen:
+        host, port = args.listen.rsplit(':', 1)
+        serve(service, host, int(port))
+    if args.tail:
+        tail(service, args.tail, args.from_start)
+    try:
+        while True:
+            time.sleep(args.stats_every)
+            print(' '.join(f'{k}={v:.6g}' for k, v in service.stats().items()),
+                  file=sys.stderr, flush=True)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()